@@ -1,11 +1,21 @@
-from flask import Flask, render_template, request
+from flask import Flask, jsonify, render_template, request
 import pymongo
 import os
+import json
 import logging
+import math
+import time
+from itertools import accumulate
 from dotenv import load_dotenv
 from urllib.parse import quote
-from datetime import datetime
+from datetime import datetime, timedelta
 from json2html import *
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+from card_catalog import load_card_catalog
+from matchup_matrix import card_matchups
+from rollups import CHECKPOINT_ID
+from sketches import CountMinSketch, HyperLogLog
 
 # Carregar variáveis de ambiente do arquivo .env
 load_dotenv()
@@ -15,15 +25,100 @@ app = Flask(__name__)
 # Configurações do MongoDB
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = "clash_royale"
-CLIENT = pymongo.MongoClient(MONGO_URI)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "60000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "10000"))
+# Tempo (segundos) que os dados da pagina inicial ficam em cache
+INDEX_CACHE_TTL = int(os.getenv("INDEX_CACHE_TTL", "300"))
+# Fracao das batalhas (sampleKey < taxa) usada pelo modo aproximado
+APPROX_SAMPLE_RATE = float(os.getenv("APPROX_SAMPLE_RATE", "0.05"))
+# Granularidades aceitas pela serie temporal de cartas ($dateTrunc)
+TREND_BUCKETS = ("hour", "day", "week")
+# Dias analisados antes do primeiro e depois do ultimo update no impacto de patches
+PATCH_WINDOW_DAYS = int(os.getenv("PATCH_WINDOW_DAYS", "14"))
+
+
+def create_client():
+    # connect=False adia a abertura das conexoes ate a primeira operacao, o que
+    # permite importar o modulo no processo mestre antes do fork dos workers
+    return pymongo.MongoClient(
+        MONGO_URI,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+        socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+        waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        connect=False,
+    )
+
+
+CLIENT = create_client()
 DB = CLIENT[DB_NAME]
 
+# Cache dos dados exibidos na pagina inicial: chave -> (expira_em, valor)
+_INDEX_CACHE = {}
+
+
+def reset_client():
+    # Chamado em cada worker depois do fork: o MongoClient nao e fork-safe,
+    # entao cada processo cria o seu proprio pool de conexoes
+    global CLIENT, DB
+    CLIENT = create_client()
+    DB = CLIENT[DB_NAME]
+    _INDEX_CACHE.clear()
+
+
+def cached(key, loader):
+    entry = _INDEX_CACHE.get(key)
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    value = loader()
+    if value:
+        _INDEX_CACHE[key] = (time.monotonic() + INDEX_CACHE_TTL, value)
+    return value
+
+
+def sample_filter(match, approx):
+    # No modo aproximado le apenas a amostra sorteada na ingestao (sampleKey)
+    if approx:
+        return dict(match, sampleKey={"$lt": APPROX_SAMPLE_RATE})
+    return match
+
+
+def proportion_margin(rate, total):
+    # Margem de erro (95%) de uma porcentagem estimada sobre total amostras
+    if not total:
+        return None
+    proportion = rate / 100
+    return 1.96 * math.sqrt(proportion * (1 - proportion) / total) * 100
+
+
+def extrapolate_count(result, field):
+    # Extrapola a contagem da amostra e calcula a margem (95%) do estimador
+    sampled = result[field]
+    result[field] = sampled / APPROX_SAMPLE_RATE
+    result["margin"] = 1.96 * math.sqrt(sampled * (1 - APPROX_SAMPLE_RATE)) / APPROX_SAMPLE_RATE
+
+
+def approximate_response(results, match, sample_size=None):
+    if sample_size is None:
+        sample_size = DB["battles"].count_documents(sample_filter(match, True))
+    return {
+        "approximate": True,
+        "sampleRate": APPROX_SAMPLE_RATE,
+        "sampleSize": sample_size,
+        "results": results,
+    }
+
 
 @app.route("/")
 def index():
     # Obter nomes de cartas e datas válidas
-    card_names = get_card_names()
-    battle_dates = get_battle_dates()
+    card_names = cached("card_names", get_card_names)
+    battle_dates = cached("battle_dates", get_battle_dates)
     return render_template(
         "index.html", card_names=card_names, battle_dates=battle_dates
     )
@@ -34,13 +129,14 @@ def victory_percentage():
     card_name = request.form["card_name"]
     start_time = request.form["start_time"]
     end_time = request.form["end_time"]
-    results = victory_percentage_with_card(card_name, start_time, end_time)
+    approx = request.form.get("approx") == "true"
+    results = victory_percentage_with_card(card_name, start_time, end_time, approx)
     logging.debug(f"Results: {results}")
     html = json2html.convert(json=results)
     return render_template("results.html", results=html)
 
 
-def victory_percentage_with_card(card_name, start_time, end_time):
+def victory_percentage_with_card(card_name, start_time, end_time, approx=False):
     logging.debug(f"Querying for card: {card_name}, from {start_time} to {end_time}")
 
     # Converter start_time e end_time para o formato ISO8601
@@ -49,14 +145,17 @@ def victory_percentage_with_card(card_name, start_time, end_time):
 
     logging.debug(f"Converted start_time: {start_iso}, end_time: {end_iso}")
 
+    card_id = load_card_catalog(DB).id_of(card_name)
+    window = {"battleTime": {"$gte": start_iso, "$lt": end_iso}}
+
     pipeline = [
         # Filtra pelo periodo da batalha
-        {"$match": {"battleTime": {"$gte": start_iso, "$lt": end_iso}}},
+        {"$match": sample_filter(window, approx)},
         # Cria campos booleanos informando em qual lado a carta esta presente
         {
             "$project": {
-                "winnerHasCard": {"$in": [card_name, "$winner.deck.name"]},
-                "loserHasCard": {"$in": [card_name, "$loser.deck.name"]},
+                "winnerHasCard": {"$in": [card_id, "$winner.cards"]},
+                "loserHasCard": {"$in": [card_id, "$loser.cards"]},
             }
         },
         # Agrupa todos os documentos e soma as quantidades de vitoria e derrota
@@ -67,6 +166,9 @@ def victory_percentage_with_card(card_name, start_time, end_time):
                 "totalLosses": {"$sum": {"$cond": ["$loserHasCard", 1, 0]}},
             }
         },
+        # Descarta o grupo quando nenhuma batalha (ou nenhuma da amostra) tem
+        # a carta, evitando a divisao por zero
+        {"$match": {"$expr": {"$gt": [{"$add": ["$totalWins", "$totalLosses"]}, 0]}}},
         # Calcula as porcentagens de vitorias e derrotas.
         {
             "$project": {
@@ -97,9 +199,17 @@ def victory_percentage_with_card(card_name, start_time, end_time):
         },
     ]
 
+    if approx:
+        # Mantem o total de jogos da amostra para calcular a margem de erro
+        pipeline[-1]["$project"]["sampleGames"] = {"$add": ["$totalWins", "$totalLosses"]}
+
     logging.debug(f"Pipeline: {pipeline}")
     results = list(DB["battles"].aggregate(pipeline))
     logging.debug(f"Pipeline results: {results}")
+    if approx:
+        for result in results:
+            result["margin"] = proportion_margin(result["winPercentage"], result["sampleGames"])
+        return approximate_response(results, window)
     return results
 
 
@@ -110,8 +220,9 @@ def high_win_decks():
     offset = float(request.form["offset"])
     start_time = request.form["start_time_deck"]
     end_time = request.form["end_time_deck"]
+    approx = request.form.get("approx") == "true"
     results = decks_with_high_win_percentage(
-        win_percentage, start_time, end_time, limit, offset
+        win_percentage, start_time, end_time, limit, offset, approx
     )
     logging.debug(f"Results: {results}")
     html = json2html.convert(json=results)
@@ -119,7 +230,7 @@ def high_win_decks():
 
 
 def decks_with_high_win_percentage(
-    min_win_percentage, start_time, end_time, limit, offset
+    min_win_percentage, start_time, end_time, limit, offset, approx=False
 ):
     logging.debug(
         f"Querying for decks with at least {min_win_percentage}% wins, from {start_time} to {end_time}"
@@ -127,17 +238,33 @@ def decks_with_high_win_percentage(
 
     start_iso = datetime.strptime(start_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
     end_iso = datetime.strptime(end_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+    window = {"battleTime": {"$gte": start_iso, "$lt": end_iso}}
+
+    # No modo aproximado o $lookup tambem conta os jogos apenas na amostra
+    # (sampleKey ausente fica de fora, como no filtro da amostra)
+    lookup_sample = (
+        [
+            {"$gte": ["$sampleKey", 0]},
+            {"$lt": ["$sampleKey", APPROX_SAMPLE_RATE]},
+        ]
+        if approx
+        else []
+    )
 
     pipeline = [
         # Filtra pelo periodo da batalha e extrai apenas os decks completos
         {
-            "$match": {
-                "battleTime": {"$gte": start_iso, "$lt": end_iso},
-                "winner.deck": {"$size": 8},
-            },
+            "$match": sample_filter(dict(window, **{"winner.cards": {"$size": 8}}), approx),
+        },
+        # Extrai o deck do vencedor (ids ordenados, para decks iguais em
+        # ordens diferentes cairem no mesmo grupo) e marca cada entrada como
+        # uma vitoria
+        {
+            "$project": {
+                "winnerDeck": {"$sortArray": {"input": "$winner.cards", "sortBy": 1}},
+                "isWin": {"$literal": 1},
+            }
         },
-        # Extrai o deck do vencedor e marca cada entrada como uma vitoria
-        {"$project": {"winnerDeck": "$winner.deck.name", "isWin": {"$literal": 1}}},
         # Agrupa os documentos pelo deck do vencedor e conta as vitórias para cada deck
         {"$group": {"_id": "$winnerDeck", "totalWins": {"$sum": "$isWin"}}},
         # Join na colecao original para contar quantas vezes cada deck
@@ -153,10 +280,21 @@ def decks_with_high_win_percentage(
                                 "$and": [
                                     {"$gte": ["$battleTime", start_iso]},
                                     {"$lt": ["$battleTime", end_iso]},
+                                    *lookup_sample,
                                     {
                                         "$or": [
-                                            {"$eq": ["$winner.deck.name", "$$deck"]},
-                                            {"$eq": ["$loser.deck.name", "$$deck"]},
+                                            {
+                                                "$eq": [
+                                                    {"$sortArray": {"input": "$winner.cards", "sortBy": 1}},
+                                                    "$$deck",
+                                                ]
+                                            },
+                                            {
+                                                "$eq": [
+                                                    {"$sortArray": {"input": "$loser.cards", "sortBy": 1}},
+                                                    "$$deck",
+                                                ]
+                                            },
                                         ]
                                     },
                                 ]
@@ -199,8 +337,21 @@ def decks_with_high_win_percentage(
         {"$sort": {"winPercentage": -1}},
     ]
 
+    if approx:
+        # Mantem o total de jogos do deck na amostra para a margem de erro
+        pipeline[4]["$project"]["sampleGames"] = {
+            "$ifNull": [{"$arrayElemAt": ["$gameStats.totalGames", 0]}, 0]
+        }
+
+    catalog = load_card_catalog(DB)
     results = list(DB["battles"].aggregate(pipeline))
+    for result in results:
+        result["deck"] = catalog.names_of(result["deck"])
     logging.debug(f"Pipeline results: {results}")
+    if approx:
+        for result in results:
+            result["margin"] = proportion_margin(result["winPercentage"], result["sampleGames"])
+        return approximate_response(results, window)
     return results
 
 
@@ -209,13 +360,14 @@ def defeats_with_combo():
     combo = request.form["combo"].split(",")
     start_time = request.form["start_time_combo"]
     end_time = request.form["end_time_combo"]
-    results = losses_with_card_combo(combo, start_time, end_time)
+    approx = request.form.get("approx") == "true"
+    results = losses_with_card_combo(combo, start_time, end_time, approx)
     logging.debug(f"Results: {results}")
     html = json2html.convert(json=results)
     return render_template("results.html", results=html)
 
 
-def losses_with_card_combo(card_combo, start_time, end_time):
+def losses_with_card_combo(card_combo, start_time, end_time, approx=False):
     logging.debug(
         f"Querying for defeats with card combo {card_combo}, from {start_time} to {end_time}"
     )
@@ -223,9 +375,12 @@ def losses_with_card_combo(card_combo, start_time, end_time):
     start_iso = datetime.strptime(start_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
     end_iso = datetime.strptime(end_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
 
+    combo_ids = load_card_catalog(DB).ids_of(card.strip() for card in card_combo)
+    window = {"battleTime": {"$gte": start_iso, "$lt": end_iso}}
+
     pipeline = [
         # Filtra pelo periodo da batalha
-        {"$match": {"battleTime": {"$gte": start_iso, "$lt": end_iso}}},
+        {"$match": sample_filter(window, approx)},
         # Cria um novo campo que informa se elementos do combo
         # estão no deck do perdedor ou nao
         {
@@ -233,9 +388,9 @@ def losses_with_card_combo(card_combo, start_time, end_time):
                 "hasCombo": {
                     "$allElementsTrue": {
                         "$map": {
-                            "input": card_combo,
+                            "input": combo_ids,
                             "as": "card",
-                            "in": {"$in": ["$$card", "$loser.deck.name"]},
+                            "in": {"$in": ["$$card", "$loser.cards"]},
                         }
                     }
                 },
@@ -249,6 +404,10 @@ def losses_with_card_combo(card_combo, start_time, end_time):
 
     results = list(DB["battles"].aggregate(pipeline))
     logging.debug(f"Pipeline results: {results}")
+    if approx:
+        for result in results:
+            extrapolate_count(result, "totalLosses")
+        return approximate_response(results, window)
     return results
 
 
@@ -256,20 +415,24 @@ def losses_with_card_combo(card_combo, start_time, end_time):
 def specific_victories():
     card_name = request.form["card_name_victory"]
     trophy_diff = float(request.form["trophy_diff"])
-    results = specific_victory_conditions(card_name, trophy_diff)
+    approx = request.form.get("approx") == "true"
+    results = specific_victory_conditions(card_name, trophy_diff, approx)
     logging.debug(f"Results: {results}")
     html = json2html.convert(json=results)
     return render_template("results.html", results=html)
 
 
-def specific_victory_conditions(card_name, trophy_difference_percentage):
+def specific_victory_conditions(card_name, trophy_difference_percentage, approx=False):
     logging.debug(
         f"Querying for specific victories with card {card_name}, trophy diff {trophy_difference_percentage}%"
     )
 
+    card_id = load_card_catalog(DB).id_of(card_name)
+    match = {"loser.crowns": {"$gte": 2}}
+
     pipeline = [
         # Filtra batalhas on o perdedor derrubou, no minimo, 2 torres
-        {"$match": {"loser.crowns": {"$gte": 2}}},
+        {"$match": sample_filter(match, approx)},
         # Busca dados de ambos vencedores e perdedores
         {
             "$lookup": {
@@ -334,7 +497,7 @@ def specific_victory_conditions(card_name, trophy_difference_percentage):
                         },
                     ]
                 },
-                "hasCardX": {"$in": [card_name, "$winner.deck.name"]},
+                "hasCardX": {"$in": [card_id, "$winner.cards"]},
             }
         },
         # Filtra as batalhas onde o vencedor tem uma porcentagem a menos de trofeus do que o perdedor
@@ -346,6 +509,10 @@ def specific_victory_conditions(card_name, trophy_difference_percentage):
 
     results = list(DB["battles"].aggregate(pipeline))
     logging.debug(f"Pipeline results: {results}")
+    if approx:
+        for result in results:
+            extrapolate_count(result, "victoriesWithCardX")
+        return approximate_response(results, match)
     return results
 
 
@@ -355,9 +522,13 @@ def high_win_combos():
     win_percentage = float(request.form["win_percentage_combo"])
     start_time = request.form["start_time_combo"]
     end_time = request.form["end_time_combo"]
-    results = card_combos_with_high_win_percentage(
-        combo_size, win_percentage, start_time, end_time
-    )
+    approx = request.form.get("approx") == "true"
+    if approx:
+        results = approximate_card_combos(combo_size, win_percentage, start_time, end_time)
+    else:
+        results = card_combos_with_high_win_percentage(
+            combo_size, win_percentage, start_time, end_time
+        )
     logging.debug(f"Results: {results}")
     html = json2html.convert(json=results)
     return render_template("results.html", results=html)
@@ -386,7 +557,7 @@ def card_combos_with_high_win_percentage(
         },
         # Separa os decks vencedores
         {
-            "$project": {"winnerCards": "$winner.deck.name"},
+            "$project": {"winnerCards": "$winner.cards"},
         },
         # Cria um array de tamanho N referente ao combo de cartas
         {
@@ -417,41 +588,89 @@ def card_combos_with_high_win_percentage(
         {"$sort": {"winRate": -1}},
     ]
 
+    catalog = load_card_catalog(DB)
     results = list(DB["battles"].aggregate(pipeline))
+    for result in results:
+        result["combo"] = catalog.names_of(result["combo"])
     logging.debug(f"Pipeline results: {results}")
     return results
 
 
+def approximate_card_combos(combo_size, min_win_percentage, start_time, end_time):
+    logging.debug(
+        f"Approximating card combos of size {combo_size} with at least {min_win_percentage}% wins"
+    )
+
+    start_iso = datetime.strptime(start_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+    end_iso = datetime.strptime(end_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+    window = {"battleTime": {"$gte": start_iso, "$lt": end_iso}}
+
+    sample_size = DB["battles"].count_documents(sample_filter(window, True))
+    # Um combo so pode passar do limite se aparecer em pelo menos threshold vitorias
+    threshold = min_win_percentage / 100 * sample_size
+
+    # Percorre a amostra contando os combos em um Count-Min sketch e guarda
+    # apenas os candidatos cuja estimativa ja passou do limite
+    sketch = CountMinSketch()
+    candidates = {}
+    cursor = DB["battles"].find(sample_filter(window, True), {"_id": 0, "winner.cards": 1})
+    for battle in cursor:
+        combo = tuple(battle["winner"]["cards"][:combo_size])
+        estimate = sketch.add(combo)
+        if estimate > threshold:
+            candidates[combo] = estimate
+
+    catalog = load_card_catalog(DB)
+    error_bound = sketch.error_bound()
+    results = []
+    for combo in candidates:
+        estimate = sketch.estimate(combo)
+        win_rate = estimate / sample_size * 100
+        if win_rate <= min_win_percentage:
+            continue
+        results.append(
+            {
+                "combo": catalog.names_of(combo),
+                "winRate": win_rate,
+                # Margem do sketch (superestimativa maxima) somada a da amostragem
+                "margin": error_bound / sample_size * 100
+                + proportion_margin(win_rate, sample_size),
+            }
+        )
+    results.sort(key=lambda result: result["winRate"], reverse=True)
+    return approximate_response(results, window, sample_size)
+
+
 @app.route("/card_win_after_update", methods=["POST"])
 def card_win_after_update():
 
     card_name = request.form["card_name"]
     update_time = request.form["update_time"]
-    results = card_win_rate_after_before_time(card_name, update_time)
+    approx = request.form.get("approx") == "true"
+    results = card_win_rate_after_before_time(card_name, update_time, approx)
     logging.debug(f"Results: {results}")
     html = json2html.convert(json=results)
     return render_template("results.html", results=html)
 
 
-def card_win_rate_after_before_time(card_name, update_time):
+def card_win_rate_after_before_time(card_name, update_time, approx=False):
     logging.debug(f"Querying for cards win dif after updates")
 
     update_iso = datetime.strptime(update_time, "%Y-%m-%d").strftime(
         "%Y%m%dT%H%M%S.000Z"
     )
 
+    card_id = load_card_catalog(DB).id_of(card_name)
+    match = {"$or": [{"winner.cards": card_id}, {"loser.cards": card_id}]}
+
     pipeline = [
         # Busca batalhas em que a carta especifica participou
-        {
-            "$match": {
-                "$or": [{"winner.deck.name": card_name}, {"loser.deck.name": card_name}]
-            }
-        },
+        {"$match": sample_filter(match, approx)},
         # Projeta os campos que informa se a carta esta no lado vencedor.
         # cria tambem o campo mostrando se a batalha foi antes ou depois da data de update
         {
             "$project": {
-                "cardInWinnerDeck": {"$in": [card_name, "$winner.deck.name"]},
+                "cardInWinnerDeck": {"$in": [card_id, "$winner.cards"]},
                 "isBeforeUpdate": {"$lt": ["$battleTime", update_iso]},
             }
         },
@@ -532,9 +751,248 @@ def card_win_rate_after_before_time(card_name, update_time):
         },
     ]
 
+    if approx:
+        # Mantem o total de jogos de cada periodo na amostra para as margens
+        pipeline[-1]["$project"]["beforeGames"] = "$beforeUpdate.totalGames"
+        pipeline[-1]["$project"]["afterGames"] = "$afterUpdate.totalGames"
+
     results = list(DB["battles"].aggregate(pipeline))
     print(results)
     logging.debug(f"Pipeline results: {results}")
+    if approx:
+        for result in results:
+            result["beforeMargin"] = proportion_margin(
+                result["beforeWinRate"], result.get("beforeGames")
+            )
+            result["afterMargin"] = proportion_margin(
+                result["afterWinRate"], result.get("afterGames")
+            )
+        return approximate_response(results, match)
+    return results
+
+
+@app.route("/patch_impact", methods=["POST"])
+def patch_impact():
+
+    patch_dates = [date for date in request.form["patch_dates"].split(",") if date.strip()]
+    min_games = int(request.form.get("min_games") or 30)
+    limit = int(request.form.get("limit") or 10)
+    window_days = int(request.form.get("window_days") or PATCH_WINDOW_DAYS)
+    results = patch_impact_comparison(patch_dates, min_games, limit, window_days)
+    logging.debug(f"Results: {results}")
+    html = json2html.convert(json=results)
+    return render_template("results.html", results=html)
+
+
+def patch_impact_comparison(patch_dates, min_games=30, limit=10, window_days=PATCH_WINDOW_DAYS):
+    logging.debug(f"Querying patch impact for update dates {patch_dates}")
+
+    patch_isos = sorted(
+        datetime.strptime(patch_date.strip(), "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+        for patch_date in patch_dates
+    )
+    if not patch_isos:
+        return []
+
+    # Restringe o periodo analisado a window_days antes do primeiro
+    # update e depois do ultimo; window_days <= 0 usa todas as batalhas
+    match = {}
+    if window_days > 0:
+        first = datetime.strptime(patch_isos[0], "%Y%m%dT%H%M%S.000Z")
+        last = datetime.strptime(patch_isos[-1], "%Y%m%dT%H%M%S.000Z")
+        match["battleTime"] = {
+            "$gte": (first - timedelta(days=window_days)).strftime("%Y%m%dT%H%M%S.000Z"),
+            "$lt": (last + timedelta(days=window_days)).strftime("%Y%m%dT%H%M%S.000Z"),
+        }
+
+    # Indice da janela entre updates: 0 antes do primeiro update,
+    # i entre o update i-1 e o update i, len(patch_isos) depois do ultimo
+    patch_window = {
+        "$switch": {
+            "branches": [
+                {"case": {"$lt": ["$battleTime", patch_iso]}, "then": index}
+                for index, patch_iso in enumerate(patch_isos)
+            ],
+            "default": len(patch_isos),
+        }
+    }
+
+    pipeline = [
+        # Filtra pelo periodo analisado
+        {"$match": match},
+        # Projeta a janela da batalha, todas as cartas e as cartas do vencedor.
+        # A entrada null em allCards e uma sentinela por batalha: o grupo dela
+        # conta as batalhas da janela na mesma passada das cartas
+        {
+            "$project": {
+                "window": patch_window,
+                "allCards": {
+                    "$concatArrays": [
+                        [None],
+                        {"$setUnion": ["$winner.cards", "$loser.cards"]},
+                    ]
+                },
+                "winnerCards": "$winner.cards",
+            }
+        },
+        # Destrincha o array allCards para tratar cada carta separadamente
+        {"$unwind": "$allCards"},
+        # Agrupa por janela e carta somando vitorias e usos em uma unica passada
+        {
+            "$group": {
+                "_id": {"window": "$window", "card": "$allCards"},
+                "totalWins": {
+                    "$sum": {"$cond": [{"$in": ["$allCards", "$winnerCards"]}, 1, 0]}
+                },
+                "totalUses": {"$sum": 1},
+            }
+        },
+    ]
+
+    card_stats = {}
+    window_battles = {}
+    for row in DB["battles"].aggregate(pipeline):
+        if row["_id"]["card"] is None:
+            window_battles[row["_id"]["window"]] = row["totalUses"]
+        else:
+            card_stats[(row["_id"]["window"], row["_id"]["card"])] = row
+
+    catalog = load_card_catalog(DB)
+    results = []
+    for index, patch_iso in enumerate(patch_isos):
+        patch_results = []
+        cards = {card for window, card in card_stats if window in (index, index + 1)}
+        for card in cards:
+            before = card_stats.get((index, card))
+            after = card_stats.get((index + 1, card))
+            if before is None or after is None:
+                continue
+            if before["totalUses"] < min_games or after["totalUses"] < min_games:
+                continue
+
+            before_rate = before["totalWins"] / before["totalUses"]
+            after_rate = after["totalWins"] / after["totalUses"]
+            delta = after_rate - before_rate
+            margin = 1.96 * math.sqrt(
+                before_rate * (1 - before_rate) / before["totalUses"]
+                + after_rate * (1 - after_rate) / after["totalUses"]
+            )
+            before_usage = before["totalUses"] / window_battles[index]
+            after_usage = after["totalUses"] / window_battles[index + 1]
+
+            patch_results.append(
+                {
+                    "patchDate": datetime.strptime(patch_iso, "%Y%m%dT%H%M%S.000Z")
+                    .date()
+                    .isoformat(),
+                    "card": catalog.name_of(card),
+                    "beforeGames": before["totalUses"],
+                    "afterGames": after["totalUses"],
+                    "beforeWinRate": before_rate * 100,
+                    "afterWinRate": after_rate * 100,
+                    "winRateDelta": delta * 100,
+                    "winRateDeltaCI95": [(delta - margin) * 100, (delta + margin) * 100],
+                    "beforeUsageRate": before_usage * 100,
+                    "afterUsageRate": after_usage * 100,
+                    "usageRateDelta": (after_usage - before_usage) * 100,
+                }
+            )
+
+        # Ordena pelas cartas mais afetadas pelo update
+        patch_results.sort(key=lambda result: abs(result["winRateDelta"]), reverse=True)
+        results.extend(patch_results[:limit])
+
+    logging.debug(f"Patch impact results: {results}")
+    return results
+
+
+@app.route("/card_matchups", methods=["POST"])
+def matchups():
+
+    card_name = request.form["card_name"]
+    start_time = request.form["start_time"]
+    end_time = request.form["end_time"]
+    limit = int(request.form.get("limit") or 5)
+    min_games = int(request.form.get("min_games") or 20)
+    results = card_matchups(DB, card_name, start_time, end_time, limit, min_games, build=False)
+    logging.debug(f"Results: {results}")
+    html = json2html.convert(json=results)
+    return render_template("results.html", results=html)
+
+
+@app.route("/archetype_win_rate", methods=["POST"])
+def archetype_win_rate():
+
+    start_time = request.form["start_time"]
+    end_time = request.form["end_time"]
+    min_games = int(request.form.get("min_games") or 30)
+    limit = int(request.form.get("limit") or 30)
+    results = archetypes_win_rate(start_time, end_time, min_games, limit)
+    logging.debug(f"Results: {results}")
+    html = json2html.convert(json=results)
+    return render_template("results.html", results=html)
+
+
+def archetypes_win_rate(start_time, end_time, min_games=30, limit=30):
+    logging.debug(f"Querying for archetypes win rate, from {start_time} to {end_time}")
+
+    start_iso = datetime.strptime(start_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+    end_iso = datetime.strptime(end_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+
+    pipeline = [
+        # Filtra pelo periodo da batalha
+        {"$match": {"battleTime": {"$gte": start_iso, "$lt": end_iso}}},
+        # Cria uma entrada por lado da batalha com o arquetipo e o resultado
+        {
+            "$project": {
+                "sides": [
+                    {"archetype": "$winner.archetype", "win": 1},
+                    {"archetype": "$loser.archetype", "win": 0},
+                ]
+            }
+        },
+        {"$unwind": "$sides"},
+        # Descarta batalhas ainda nao classificadas pelo job de arquetipos
+        {"$match": {"sides.archetype": {"$ne": None}}},
+        # Soma vitorias e jogos de cada arquetipo
+        {
+            "$group": {
+                "_id": "$sides.archetype",
+                "totalWins": {"$sum": "$sides.win"},
+                "totalGames": {"$sum": 1},
+            }
+        },
+        {"$match": {"totalGames": {"$gte": min_games}}},
+        # Busca o deck representante do arquetipo
+        {
+            "$lookup": {
+                "from": "archetypes",
+                "localField": "_id",
+                "foreignField": "_id",
+                "as": "archetype",
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "archetype": "$_id",
+                "deck": {"$arrayElemAt": ["$archetype.deck", 0]},
+                "totalGames": 1,
+                "winRate": {
+                    "$multiply": [{"$divide": ["$totalWins", "$totalGames"]}, 100]
+                },
+            }
+        },
+        # Ordena pela taxa de vitoria decrescente
+        {"$sort": {"winRate": -1}},
+        {"$limit": limit},
+    ]
+
+    catalog = load_card_catalog(DB)
+    results = list(DB["battles"].aggregate(pipeline))
+    for result in results:
+        result["deck"] = catalog.names_of(result.get("deck", []))
+    logging.debug(f"Pipeline results: {results}")
     return results
 
 
@@ -545,38 +1003,41 @@ def cards_high_win_less_used():
     usage_percentage = float(request.form["usage_percentage"])
     start_time = request.form["start_time"]
     end_time = request.form["end_time"]
+    approx = request.form.get("approx") == "true"
     results = cards_win_rate_usage_rate(
-        win_percentage, usage_percentage, start_time, end_time
+        win_percentage, usage_percentage, start_time, end_time, approx
     )
     logging.debug(f"Results: {results}")
     html = json2html.convert(json=results)
     return render_template("results.html", results=html)
 
 
-def cards_win_rate_usage_rate(win_percentage, usage_percentage, start_time, end_time):
+def cards_win_rate_usage_rate(
+    win_percentage, usage_percentage, start_time, end_time, approx=False
+):
 
     logging.debug(f"Querying for cards win rate and usage rate")
 
     start_iso = datetime.strptime(start_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
     end_iso = datetime.strptime(end_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
 
+    window = {"battleTime": {"$gte": start_iso, "$lte": end_iso}}
+
     # obtem a quantidade total de batalhas
-    totalBattles = DB["battles"].count_documents({})
+    totalBattles = DB["battles"].count_documents(sample_filter({}, approx))
 
     pipeline = [
         # Filtra as batalhas pelo periodo
         {
-            "$match": {
-                "battleTime": {"$gte": start_iso, "$lte": end_iso},
-            },
+            "$match": sample_filter(window, approx),
         },
         # Projeta campo com todas as cartas e outro campos so com as cartas do vencedor
         {
             "$project": {
                 "allCards": {
-                    "$setUnion": ["$winner.deck.name", "$loser.deck.name"],
+                    "$setUnion": ["$winner.cards", "$loser.cards"],
                 },
-                "winnerCards": "$winner.deck.name",
+                "winnerCards": "$winner.cards",
             },
         },
         # Destrincha o array allCards para tratar cada carta separadamente
@@ -627,9 +1088,21 @@ def cards_win_rate_usage_rate(win_percentage, usage_percentage, start_time, end_
         },
     ]
 
+    if approx:
+        # Mantem os usos da amostra para calcular a margem de erro
+        pipeline[-3]["$project"]["sampleUses"] = "$totalUses"
+
+    catalog = load_card_catalog(DB)
     results = list(DB["battles"].aggregate(pipeline))
+    for result in results:
+        result["card"] = catalog.name_of(result["card"])
     print(results)
     logging.debug(f"Pipeline results: {results}")
+    if approx:
+        for result in results:
+            result["winRateMargin"] = proportion_margin(result["winRate"], result["sampleUses"])
+            result["usageRateMargin"] = proportion_margin(result["usageRate"], totalBattles)
+        return approximate_response(results, window)
     return results
 
 
@@ -639,24 +1112,30 @@ def card_win_level_player():
     card_name = request.form["card_name"]
     start_time = request.form["start_time"]
     end_time = request.form["end_time"]
-    results = card_high_win_dif_level_player(card_name, start_time, end_time)
+    approx = request.form.get("approx") == "true"
+    results = card_high_win_dif_level_player(card_name, start_time, end_time, approx)
     logging.debug(f"Results: {results}")
     html = json2html.convert(json=results)
     return render_template("results.html", results=html)
 
 
-def card_high_win_dif_level_player(card_name, start_time, end_time):
+def card_high_win_dif_level_player(card_name, start_time, end_time, approx=False):
     logging.debug(f"Querying for high win cards rate for dif level players")
 
     start_iso = datetime.strptime(start_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
     end_iso = datetime.strptime(end_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
 
+    card_id = load_card_catalog(DB).id_of(card_name)
+    window = {"battleTime": {"$gte": start_iso, "$lt": end_iso}}
+
     pipeline = [
-        # Filtra as batalhas pelo periodo
+        # Filtra as batalhas pelo periodo e pela presenca da carta em algum
+        # dos decks, usando os indices multikey de cada lado
         {
-            "$match": {
-                "battleTime": {"$gte": start_iso, "$lt": end_iso},
-            },
+            "$match": sample_filter(
+                dict(window, **{"$or": [{"winner.cards": card_id}, {"loser.cards": card_id}]}),
+                approx,
+            ),
         },
         # Obtem as infos do ganhador
         {
@@ -676,75 +1155,43 @@ def card_high_win_dif_level_player(card_name, start_time, end_time):
                 "as": "loser_info",
             },
         },
-        # projeta os niveis de cada jogador juntamente com campos
-        # que  informam a presença das cartas em seus decks
+        # Cria uma entrada por lado da batalha com o nivel do jogador,
+        # se ele usou a carta e se venceu
         {
             "$project": {
-                "winnerLevel": {
-                    "$arrayElemAt": ["$winner_info.expLevel", 0],
-                },
-                "loserLevel": {
-                    "$arrayElemAt": ["$loser_info.expLevel", 0],
-                },
-                "cardInWinnerDeck": {
-                    "$in": [card_name, "$winner.deck.name"],
-                },
-                "cardInLoserDeck": {
-                    "$in": [card_name, "$loser.deck.name"],
-                },
-            },
-        },
-        # Cria dois novos campos: win calcula o total de vitorias por nivel
-        # e total games retor o total de jogos com a carta presente
-        {
-            "$facet": {
-                "win": [
+                "sides": [
                     {
-                        "$match": {"cardInWinnerDeck": True},
+                        "level": {"$arrayElemAt": ["$winner_info.expLevel", 0]},
+                        "hasCard": {"$in": [card_id, "$winner.cards"]},
+                        "win": 1,
                     },
                     {
-                        "$group": {"_id": "$winnerLevel", "totalWin": {"$sum": 1}},
-                    },
-                    {"$project": {"_id": 0, "totalWin": 1, "level": "$_id"}},
-                ],
-                "totalGames": [
-                    {
-                        "$match": {
-                            "$expr": {
-                                "$or": [
-                                    {"$eq": ["$cardInLoserDeck", True]},
-                                    {"$eq": ["$cardInWinnerDeck", True]},
-                                ],
-                            },
-                        },
-                    },
-                    {
-                        "$group": {"_id": None, "total": {"$sum": 1}},
-                    },
-                    {
-                        "$project": {"_id": 0, "total": 1},
+                        "level": {"$arrayElemAt": ["$loser_info.expLevel", 0]},
+                        "hasCard": {"$in": [card_id, "$loser.cards"]},
+                        "win": 0,
                     },
                 ],
             },
         },
-        # projeta as um array de vitorias e o coampo de total de jogos
+        {"$unwind": "$sides"},
+        # Mantem apenas os lados que usaram a carta
+        {"$match": {"sides.hasCard": True}},
+        # Agrupa por nivel somando vitorias e jogos com a carta
         {
-            "$project": {
-                "victorys": "$win",
-                "totalBattles": {"$arrayElemAt": ["$totalGames", 0]},
+            "$group": {
+                "_id": "$sides.level",
+                "totalWins": {"$sum": "$sides.win"},
+                "totalGames": {"$sum": 1},
             },
         },
-        # desmenbra os intens de victorys para facilitar o calculo de porcentagem
-        {"$unwind": "$victorys"},
         # projeta o nivel e calcula a taxa de vitoria da carta por nivel
         {
             "$project": {
-                "level": "$victorys.level",
+                "_id": 0,
+                "level": "$_id",
+                "totalGames": 1,
                 "winRate": {
-                    "$multiply": [
-                        {"$divide": ["$victorys.totalWin", "$totalBattles.total"]},
-                        100,
-                    ]
+                    "$multiply": [{"$divide": ["$totalWins", "$totalGames"]}, 100]
                 },
             }
         },
@@ -755,12 +1202,595 @@ def card_high_win_dif_level_player(card_name, start_time, end_time):
     results = list(DB["battles"].aggregate(pipeline))
     print(results)
     logging.debug(f"Pipeline results: {results}")
+    if approx:
+        # totalGames passa a ser o total de jogos do nivel na amostra
+        for result in results:
+            result["margin"] = proportion_margin(result["winRate"], result["totalGames"])
+        return approximate_response(results, window)
+    return results
+
+
+@app.route("/distinct_decks", methods=["POST"])
+def distinct_decks():
+
+    start_time = request.form["start_time"]
+    end_time = request.form["end_time"]
+    approx = request.form.get("approx") == "true"
+    results = distinct_decks_count(start_time, end_time, approx)
+    logging.debug(f"Results: {results}")
+    html = json2html.convert(json=results)
+    return render_template("results.html", results=html)
+
+
+def distinct_decks_count(start_time, end_time, approx=False):
+    logging.debug(f"Counting distinct decks, from {start_time} to {end_time}")
+
+    start_day = datetime.strptime(start_time, "%Y-%m-%d")
+    end_day = datetime.strptime(end_time, "%Y-%m-%d")
+
+    if approx:
+        # Combina os HyperLogLog diarios mantidos pelo consumidor de rollups
+        sketch = HyperLogLog()
+        days = 0
+        for stored in DB["deck_hll_daily"].find({"day": {"$gte": start_day, "$lt": end_day}}):
+            sketch.merge(HyperLogLog.from_bytes(stored["registers"]))
+            days += 1
+        estimate = sketch.count()
+        return {
+            "approximate": True,
+            "days": days,
+            "distinctDecks": round(estimate),
+            "margin": round(2 * sketch.relative_error() * estimate),
+        }
+
+    start_iso = start_day.strftime("%Y%m%dT%H%M%S.000Z")
+    end_iso = end_day.strftime("%Y%m%dT%H%M%S.000Z")
+    pipeline = [
+        # Filtra pelo periodo da batalha
+        {"$match": {"battleTime": {"$gte": start_iso, "$lt": end_iso}}},
+        # Cria uma entrada por deck usado na batalha
+        {"$project": {"decks": ["$winner.cards", "$loser.cards"]}},
+        {"$unwind": "$decks"},
+        # Agrupa os decks iguais (ids ordenados) e conta quantos grupos existem
+        {"$group": {"_id": {"$sortArray": {"input": "$decks", "sortBy": 1}}}},
+        {"$count": "distinctDecks"},
+    ]
+    results = list(DB["battles"].aggregate(pipeline, allowDiskUse=True))
+    logging.debug(f"Pipeline results: {results}")
     return results
 
 
+@app.route("/card_trends", methods=["POST"])
+def card_trends():
+
+    card_names = request.form.getlist("card_names")
+    start_time = request.form["start_time"]
+    end_time = request.form["end_time"]
+    bucket = request.form.get("bucket") or "day"
+    window = int(request.form.get("window") or 7)
+    results = card_trends_series(card_names, start_time, end_time, bucket, window)
+    logging.debug(f"Results: {results}")
+    if request.form.get("format") == "json":
+        return jsonify(results)
+    return render_template("trends.html", chart=trends_chart(results))
+
+
+def rolling_rate(numerators, denominators, window):
+    # Taxa suavizada pela razao entre as somas da janela, para que buckets com
+    # poucos jogos nao pesem tanto quanto os cheios
+    numerator_sums = [0, *accumulate(numerators)]
+    denominator_sums = [0, *accumulate(denominators)]
+    rates = []
+    for position in range(1, len(numerator_sums)):
+        first = max(0, position - window)
+        denominator = denominator_sums[position] - denominator_sums[first]
+        numerator = numerator_sums[position] - numerator_sums[first]
+        rates.append(numerator / denominator * 100 if denominator else None)
+    return rates
+
+
+def card_trends_series(card_names, start_time, end_time, bucket="day", window=7):
+    logging.debug(f"Querying trends for cards: {card_names}, from {start_time} to {end_time}")
+
+    if bucket not in TREND_BUCKETS:
+        bucket = "day"
+    window = max(1, window)
+    start_day = datetime.strptime(start_time, "%Y-%m-%d")
+    end_day = datetime.strptime(end_time, "%Y-%m-%d")
+
+    catalog = load_card_catalog(DB)
+    card_ids = [card_id for card_id in catalog.ids_of(card_names) if card_id is not None]
+
+    # Inicio do bucket (hora, dia ou semana) calculado no servidor
+    bucket_start = {"$dateTrunc": {"date": "$hour", "unit": bucket}}
+    if bucket == "week":
+        bucket_start["$dateTrunc"]["startOfWeek"] = "monday"
+
+    # Os rollups cobrem as batalhas ate o checkpoint do consumidor; as que ele
+    # ainda nao contou (sequencia maior ou batalhas sem ingestSeq, gravadas
+    # antes dele sem --backfill) sao lidas direto da colecao e somadas.
+    # O checkpoint e lido antes dos rollups: um flush entre as duas leituras
+    # conta o lote dele duas vezes, nunca deixa batalhas de fora
+    checkpoint = DB["rollup_checkpoints"].find_one({"_id": CHECKPOINT_ID}) or {}
+    start_iso = start_day.strftime("%Y%m%dT%H%M%S.000Z")
+    end_iso = end_day.strftime("%Y%m%dT%H%M%S.000Z")
+    uncovered = {
+        "battleTime": {"$gte": start_iso, "$lt": end_iso},
+        "restored": {"$ne": True},
+        "$or": [{"ingestSeq": None}, {"ingestSeq": {"$gt": checkpoint.get("seq", 0)}}],
+    }
+
+    # Le os rollups horarios mantidos pelo consumidor (rollups.py)
+    hour_match = {"hour": {"$gte": start_day, "$lt": end_day}}
+    rollup_totals = list(
+        DB["battle_hourly"].aggregate(
+            [
+                {"$match": hour_match},
+                {"$group": {"_id": bucket_start, "battles": {"$sum": "$battles"}}},
+            ]
+        )
+    )
+    rollup_counts = DB["card_hourly"].aggregate(
+        [
+            {"$match": dict(hour_match, card={"$in": card_ids})},
+            {
+                "$group": {
+                    "_id": {"card": "$card", "bucket": bucket_start},
+                    "wins": {"$sum": "$wins"},
+                    "uses": {"$sum": "$uses"},
+                }
+            },
+        ]
+    )
+
+    pipeline = [
+        # Filtra as batalhas do periodo ainda nao contadas nos rollups
+        {"$match": uncovered},
+        # Converte a hora da batalha para data; uso conta uma vez por
+        # batalha (uniao dos decks), como em cards_win_rate_usage_rate
+        {
+            "$project": {
+                "hour": {
+                    "$dateFromString": {
+                        "dateString": {"$substrCP": ["$battleTime", 0, 11]},
+                        "format": "%Y%m%dT%H",
+                    }
+                },
+                "winnerCards": "$winner.cards",
+                "cards": {"$setUnion": ["$winner.cards", "$loser.cards"]},
+            }
+        },
+        # Total de batalhas e contadores das cartas por bucket na mesma passada
+        {
+            "$facet": {
+                "totals": [{"$group": {"_id": bucket_start, "battles": {"$sum": 1}}}],
+                "counts": [
+                    {"$unwind": "$cards"},
+                    {"$match": {"cards": {"$in": card_ids}}},
+                    {
+                        "$group": {
+                            "_id": {"card": "$cards", "bucket": bucket_start},
+                            "wins": {
+                                "$sum": {"$cond": [{"$in": ["$cards", "$winnerCards"]}, 1, 0]}
+                            },
+                            "uses": {"$sum": 1},
+                        }
+                    },
+                ],
+            }
+        },
+    ]
+    facet = next(DB["battles"].aggregate(pipeline, allowDiskUse=True))
+
+    sources = [
+        source
+        for source, totals in (("rollups", rollup_totals), ("battles", facet["totals"]))
+        if totals
+    ]
+    source = "+".join(sources) or "rollups"
+    totals = rollup_totals + facet["totals"]
+    counts = list(rollup_counts) + facet["counts"]
+
+    battles_by_bucket = {}
+    for total in totals:
+        battles_by_bucket[total["_id"]] = battles_by_bucket.get(total["_id"], 0) + total["battles"]
+    buckets = sorted(battles_by_bucket)
+    card_counts = {card_id: {} for card_id in card_ids}
+    for count in counts:
+        wins, uses = card_counts[count["_id"]["card"]].get(count["_id"]["bucket"], (0, 0))
+        card_counts[count["_id"]["card"]][count["_id"]["bucket"]] = (
+            wins + count["wins"],
+            uses + count["uses"],
+        )
+
+    battles = [battles_by_bucket[bucket_time] for bucket_time in buckets]
+    series = []
+    for card_id in card_ids:
+        wins = [card_counts[card_id].get(bucket_time, (0, 0))[0] for bucket_time in buckets]
+        uses = [card_counts[card_id].get(bucket_time, (0, 0))[1] for bucket_time in buckets]
+        smoothed_win_rates = rolling_rate(wins, uses, window)
+        smoothed_usage_rates = rolling_rate(uses, battles, window)
+        series.append(
+            {
+                "card": catalog.name_of(card_id),
+                "points": [
+                    {
+                        "bucket": bucket_time.isoformat(),
+                        "battles": battles[position],
+                        "uses": uses[position],
+                        "winRate": wins[position] / uses[position] * 100 if uses[position] else None,
+                        "usageRate": uses[position] / battles[position] * 100,
+                        "smoothedWinRate": smoothed_win_rates[position],
+                        "smoothedUsageRate": smoothed_usage_rates[position],
+                    }
+                    for position, bucket_time in enumerate(buckets)
+                ],
+            }
+        )
+
+    return {"bucket": bucket, "window": window, "source": source, "series": series}
+
+
+def trends_chart(trends):
+    figure = make_subplots(
+        rows=2,
+        cols=1,
+        shared_xaxes=True,
+        subplot_titles=("Win Rate (%)", "Usage Rate (%)"),
+        vertical_spacing=0.08,
+    )
+    for series in trends["series"]:
+        buckets = [point["bucket"] for point in series["points"]]
+        for row, field in ((1, "smoothedWinRate"), (2, "smoothedUsageRate")):
+            figure.add_trace(
+                go.Scatter(
+                    x=buckets,
+                    y=[point[field] for point in series["points"]],
+                    mode="lines",
+                    name=series["card"],
+                    legendgroup=series["card"],
+                    showlegend=row == 1,
+                    connectgaps=True,
+                ),
+                row=row,
+                col=1,
+            )
+    figure.update_layout(
+        height=800,
+        title=f"Rolling {trends['window']}-{trends['bucket']} trends ({trends['source']})",
+    )
+    return figure.to_html(full_html=False, include_plotlyjs="cdn")
+
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = {"query": request.form["query"], "params": json.loads(request.form["params"])}
+    query = BATCH_QUERIES.get(payload.get("query"))
+    if query is None:
+        return jsonify({"error": f"Unknown batch query: {payload.get('query')}"}), 400
+    results = query(payload.get("params", []))
+    logging.debug(f"Results: {results}")
+    if request.is_json:
+        return jsonify(results)
+    html = json2html.convert(json=results)
+    return render_template("results.html", results=html)
+
+
+def batch_window(param_sets):
+    # Periodo que cobre todas as janelas do lote
+    start_iso = min(
+        datetime.strptime(params["start_time"], "%Y-%m-%d") for params in param_sets
+    ).strftime("%Y%m%dT%H%M%S.000Z")
+    end_iso = max(
+        datetime.strptime(params["end_time"], "%Y-%m-%d") for params in param_sets
+    ).strftime("%Y%m%dT%H%M%S.000Z")
+    return {"battleTime": {"$gte": start_iso, "$lt": end_iso}}
+
+
+def days_in_window(counts, params):
+    # Soma os contadores diarios (indexados por dia "YYYYMMDD") da janela
+    start_day = datetime.strptime(params["start_time"], "%Y-%m-%d").strftime("%Y%m%d")
+    end_day = datetime.strptime(params["end_time"], "%Y-%m-%d").strftime("%Y%m%d")
+    return [value for day, value in counts.items() if start_day <= day < end_day]
+
+
+def batch_victory_percentage(param_sets):
+    logging.debug(f"Batch victory percentage for {len(param_sets)} parameter sets")
+    if not param_sets:
+        return []
+
+    catalog = load_card_catalog(DB)
+    card_ids = sorted(
+        {catalog.id_of(params["card_name"]) for params in param_sets} - {None}
+    )
+
+    pipeline = [
+        # Uma unica leitura cobrindo todas as janelas, apenas das batalhas com
+        # alguma das cartas pedidas (indices de cartas + battleTime)
+        {
+            "$match": {
+                **batch_window(param_sets),
+                "$or": [
+                    {"winner.cards": {"$in": card_ids}},
+                    {"loser.cards": {"$in": card_ids}},
+                ],
+            }
+        },
+        # Cria uma entrada por lado com as cartas pedidas presentes no deck
+        {
+            "$project": {
+                "day": {"$substrBytes": ["$battleTime", 0, 8]},
+                "sides": [
+                    {"cards": {"$setIntersection": ["$winner.cards", card_ids]}, "win": 1},
+                    {"cards": {"$setIntersection": ["$loser.cards", card_ids]}, "win": 0},
+                ],
+            }
+        },
+        {"$unwind": "$sides"},
+        {"$unwind": "$sides.cards"},
+        # Vitorias e derrotas por dia e carta
+        {
+            "$group": {
+                "_id": {"day": "$day", "card": "$sides.cards"},
+                "totalWins": {"$sum": "$sides.win"},
+                "totalLosses": {"$sum": {"$subtract": [1, "$sides.win"]}},
+            }
+        },
+    ]
+
+    counts = {}
+    for result in DB["battles"].aggregate(pipeline):
+        counts.setdefault(result["_id"]["card"], {})[result["_id"]["day"]] = (
+            result["totalWins"],
+            result["totalLosses"],
+        )
+
+    batch_results = []
+    for params in param_sets:
+        days = days_in_window(counts.get(catalog.id_of(params["card_name"]), {}), params)
+        total_wins = sum(wins for wins, _ in days)
+        total_losses = sum(losses for _, losses in days)
+        results = []
+        if total_wins + total_losses:
+            results.append(
+                {
+                    "winPercentage": total_wins / (total_wins + total_losses) * 100,
+                    "lossPercentage": total_losses / (total_wins + total_losses) * 100,
+                }
+            )
+        batch_results.append({"params": params, "results": results})
+    return batch_results
+
+
+def batch_cards_win_rate_usage_rate(param_sets):
+    logging.debug(f"Batch cards win rate and usage rate for {len(param_sets)} parameter sets")
+    if not param_sets:
+        return []
+
+    # Mesmo denominador de cards_win_rate_usage_rate: total de batalhas gravadas
+    totalBattles = DB["battles"].count_documents({})
+
+    pipeline = [
+        # Filtra as batalhas pelo periodo que cobre todas as janelas
+        {"$match": batch_window(param_sets)},
+        # Uso conta uma vez por batalha (uniao dos decks)
+        {
+            "$project": {
+                "day": {"$substrBytes": ["$battleTime", 0, 8]},
+                "allCards": {"$setUnion": ["$winner.cards", "$loser.cards"]},
+                "winnerCards": "$winner.cards",
+            }
+        },
+        {"$unwind": "$allCards"},
+        # Usos e vitorias por dia e carta
+        {
+            "$group": {
+                "_id": {"day": "$day", "card": "$allCards"},
+                "totalWins": {
+                    "$sum": {"$cond": [{"$in": ["$allCards", "$winnerCards"]}, 1, 0]}
+                },
+                "totalUses": {"$sum": 1},
+            }
+        },
+    ]
+
+    counts = {}
+    for result in DB["battles"].aggregate(pipeline):
+        counts.setdefault(result["_id"]["card"], {})[result["_id"]["day"]] = (
+            result["totalWins"],
+            result["totalUses"],
+        )
+
+    catalog = load_card_catalog(DB)
+    batch_results = []
+    for params in param_sets:
+        results = []
+        for card_id, card_counts in counts.items():
+            days = days_in_window(card_counts, params)
+            total_uses = sum(uses for _, uses in days)
+            if not total_uses:
+                continue
+            win_rate = sum(wins for wins, _ in days) / total_uses * 100
+            usage_rate = total_uses / totalBattles * 100
+            if win_rate > float(params["win_percentage"]) and usage_rate < float(
+                params["usage_percentage"]
+            ):
+                results.append(
+                    {"card": catalog.name_of(card_id), "winRate": win_rate, "usageRate": usage_rate}
+                )
+        results.sort(key=lambda result: result["winRate"], reverse=True)
+        batch_results.append({"params": params, "results": results})
+    return batch_results
+
+
+def batch_card_combos(param_sets):
+    logging.debug(f"Batch card combos for {len(param_sets)} parameter sets")
+    if not param_sets:
+        return []
+
+    combo_sizes = sorted({int(params["combo_size"]) for params in param_sets})
+    pipeline = [
+        # Filtra as batalhas pelo periodo que cobre todas as janelas
+        {"$match": batch_window(param_sets)},
+        # Cria uma entrada por tamanho de combo pedido no lote
+        {
+            "$project": {
+                "day": {"$substrBytes": ["$battleTime", 0, 8]},
+                "combos": [
+                    {"size": size, "cards": {"$slice": ["$winner.cards", size]}}
+                    for size in combo_sizes
+                ],
+            }
+        },
+        {"$unwind": "$combos"},
+        # Vitorias por dia, tamanho e combo; cada janela soma os seus dias
+        {
+            "$group": {
+                "_id": {"day": "$day", "size": "$combos.size", "combo": "$combos.cards"},
+                "totalWins": {"$sum": 1},
+            }
+        },
+    ]
+
+    counts = {}
+    for result in DB["battles"].aggregate(pipeline, allowDiskUse=True):
+        key = (result["_id"]["size"], tuple(result["_id"]["combo"]))
+        counts.setdefault(key, {})[result["_id"]["day"]] = result["totalWins"]
+
+    catalog = load_card_catalog(DB)
+    batch_results = []
+    for params in param_sets:
+        start_iso = datetime.strptime(params["start_time"], "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+        end_iso = datetime.strptime(params["end_time"], "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+        # Mesmo denominador de card_combos_with_high_win_percentage
+        total_games = DB["battles"].count_documents({"battleTime": {"$gte": start_iso, "$lt": end_iso}})
+        results = []
+        for (size, combo), combo_counts in counts.items():
+            if size != int(params["combo_size"]):
+                continue
+            total_wins = sum(days_in_window(combo_counts, params))
+            win_rate = total_wins / (total_games or 1) * 100
+            if total_wins and win_rate > float(params["min_win_percentage"]):
+                results.append({"combo": catalog.names_of(combo), "winRate": win_rate})
+        results.sort(key=lambda result: result["winRate"], reverse=True)
+        batch_results.append({"params": params, "results": results})
+    return batch_results
+
+
+BATCH_QUERIES = {
+    "victory_percentage": batch_victory_percentage,
+    "cards_high_win_less_used": batch_cards_win_rate_usage_rate,
+    "high_win_combos": batch_card_combos,
+}
+
+
+@app.route("/player_profile", methods=["POST"])
+def player_profile_route():
+
+    player_tag = request.form["player_tag"].strip().upper()
+    limit = int(request.form.get("limit") or 5)
+    results = player_profile(player_tag, limit)
+    logging.debug(f"Results: {results}")
+    html = json2html.convert(json=results)
+    return render_template("results.html", results=html)
+
+
+def stats_rate(counter):
+    if not counter.get("games"):
+        return None
+    return counter["wins"] / counter["games"] * 100
+
+
+def player_profile(player_tag, limit=5):
+    logging.debug(f"Querying profile of player {player_tag}")
+
+    if not player_tag.startswith("#"):
+        player_tag = f"#{player_tag}"
+
+    # Agregados mantidos pelo consumidor de rollups; busca pelo _id (tag)
+    stats = DB["player_stats"].find_one({"_id": player_tag})
+    if stats is None:
+        return []
+
+    catalog = load_card_catalog(DB)
+    decks = sorted(
+        stats.get("decks", {}).items(), key=lambda item: item[1]["games"], reverse=True
+    )
+    cards = sorted(
+        stats.get("cards", {}).items(), key=lambda item: item[1]["games"], reverse=True
+    )
+    vs_higher = stats.get("vsHigher", {"wins": 0, "games": 0})
+
+    return [
+        {
+            "tag": stats["_id"],
+            "name": stats.get("name"),
+            "games": stats["games"],
+            "wins": stats["wins"],
+            "winRate": stats_rate(stats),
+            "vsHigherTrophies": {
+                "games": vs_higher["games"],
+                "wins": vs_higher["wins"],
+                "winRate": stats_rate(vs_higher),
+            },
+            "topDecks": [
+                {
+                    "deck": catalog.names_of(int(card_id) for card_id in key.split("-")),
+                    "games": counter["games"],
+                    "winRate": stats_rate(counter),
+                }
+                for key, counter in decks[:limit]
+            ],
+            "favouriteCards": [
+                {
+                    "card": catalog.name_of(int(card_id)),
+                    "games": counter["games"],
+                    "winRate": stats_rate(counter),
+                }
+                for card_id, counter in cards[:limit]
+            ],
+        }
+    ]
+
+
+@app.route("/player_leaderboard", methods=["POST"])
+def player_leaderboard_route():
+
+    min_games = int(request.form.get("min_games") or 20)
+    limit = int(request.form.get("limit") or 30)
+    results = player_leaderboard(min_games, limit)
+    logging.debug(f"Results: {results}")
+    html = json2html.convert(json=results)
+    return render_template("results.html", results=html)
+
+
+def player_leaderboard(min_games=20, limit=30):
+    logging.debug(f"Querying top {limit} players with at least {min_games} games")
+
+    # Percorre o indice (winRate, games) em ordem decrescente de winRate
+    cursor = (
+        DB["player_stats"]
+        .find({"games": {"$gte": min_games}}, {"name": 1, "games": 1, "wins": 1, "winRate": 1})
+        .sort("winRate", pymongo.DESCENDING)
+        .limit(limit)
+    )
+    return [
+        {
+            "tag": player["_id"],
+            "name": player.get("name"),
+            "games": player["games"],
+            "wins": player["wins"],
+            "winRate": player["winRate"],
+        }
+        for player in cursor
+    ]
+
+
 def get_card_names():
     try:
-        card_names = DB["players"].distinct("deck.name")
+        card_names = sorted(load_card_catalog(DB).names)
         logging.debug(f"Card names: {card_names}")
         return card_names
     except Exception as err:
@@ -770,18 +1800,20 @@ def get_card_names():
 
 def get_battle_dates():
     try:
-        battle_dates = DB["battles"].distinct("battleTime")
+        # Busca apenas a primeira e a ultima batalha pelo indice de battleTime
+        battle_dates = [
+            battle["battleTime"]
+            for direction in (pymongo.ASCENDING, pymongo.DESCENDING)
+            for battle in DB["battles"]
+            .find({}, {"_id": 0, "battleTime": 1})
+            .sort("battleTime", direction)
+            .limit(1)
+        ]
         # Converter datas para strings no formato ISO sem a parte do tempo
-        battle_dates = sorted(
-            set(
-                [
-                    datetime.strptime(battle_date, "%Y%m%dT%H%M%S.%fZ")
-                    .date()
-                    .isoformat()
-                    for battle_date in battle_dates
-                ]
-            )
-        )
+        battle_dates = [
+            datetime.strptime(battle_date, "%Y%m%dT%H%M%S.%fZ").date().isoformat()
+            for battle_date in battle_dates
+        ]
         logging.debug(f"Battle dates: {battle_dates}")
 
         return [battle_dates[0], battle_dates[len(battle_dates) - 1]]
@@ -790,5 +1822,35 @@ def get_battle_dates():
         return []
 
 
+def ensure_indexes():
+    # Indices multikey nas cartas de cada deck combinados com o horario da
+    # batalha, usados pelos filtros de carta + periodo
+    DB["battles"].create_index([("winner.cards", 1), ("battleTime", 1)])
+    DB["battles"].create_index([("loser.cards", 1), ("battleTime", 1)])
+    DB["battles"].create_index("battleTime")
+    DB["battles"].create_index([("battleTime", 1), ("sampleKey", 1)])
+    DB["players"].create_index("tag")
+
+
+def warm_up():
+    # Prepara o worker antes de receber requisicoes: abre o pool de conexoes,
+    # garante os indices, carrega o catalogo de cartas e os dados da pagina inicial
+    started = time.monotonic()
+    try:
+        CLIENT.admin.command("ping")
+        ensure_indexes()
+        indexes = DB["battles"].index_information()
+        catalog = load_card_catalog(DB, reload=True)
+        cached("card_names", get_card_names)
+        cached("battle_dates", get_battle_dates)
+        logging.info(
+            f"Warm-up finished in {time.monotonic() - started:.2f}s "
+            f"({len(catalog)} cards, {len(indexes)} battle indexes)"
+        )
+    except Exception as err:
+        logging.error(f"An error occurred while warming up the worker: {err}")
+
+
 if __name__ == "__main__":
+    ensure_indexes()
     app.run(debug=True)
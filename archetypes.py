@@ -0,0 +1,265 @@
+import argparse
+import hashlib
+import logging
+import os
+import zlib
+
+import numpy as np
+import pymongo
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+# Parametros do MinHash/LSH: 64 permutacoes divididas em 16 bandas de 4 linhas.
+# Com esses valores dois decks com similaridade de Jaccard 0.6 (duas cartas
+# trocadas) viram candidatos com ~89% de chance, e decks com 0.3 com ~12%.
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SIMILARITY_THRESHOLD = 0.6
+PRIME = 4294967311
+
+_RANDOM = np.random.RandomState(20240726)
+PERM_A = _RANDOM.randint(1, 2**31, size=NUM_PERM).astype(np.uint64)
+PERM_B = _RANDOM.randint(0, 2**31, size=NUM_PERM).astype(np.uint64)
+
+# Cache do processo com a atribuicao deck_key -> arquetipo
+_ARCHETYPE_CACHE = {}
+
+
+def deck_key(card_ids):
+    return "-".join(str(card_id) for card_id in sorted(card_ids))
+
+
+def card_hashes(card_ids):
+    # Os ids das cartas ja sao inteiros de 32 bits e servem direto de entrada
+    # para as permutacoes (a * x + b) mod PRIME
+    return np.array(card_ids, dtype=np.uint64)
+
+
+def minhash_signature(card_ids):
+    hashes = card_hashes(card_ids)
+    return ((hashes[:, None] * PERM_A + PERM_B) % PRIME).min(axis=0)
+
+
+def minhash_signatures(decks):
+    # Calcula as assinaturas de varios decks de uma vez; decks menores sao
+    # completados repetindo a primeira carta, o que nao altera o minimo
+    width = max(len(deck) for deck in decks)
+    hashes = np.empty((len(decks), width), dtype=np.uint64)
+    for position, deck in enumerate(decks):
+        deck_hashes = card_hashes(deck)
+        hashes[position, :] = deck_hashes[0]
+        hashes[position, : len(deck_hashes)] = deck_hashes
+    return ((hashes[:, :, None] * PERM_A + PERM_B) % PRIME).min(axis=1)
+
+
+def band_keys(signature):
+    return [
+        f"{band}:{zlib.crc32(signature[band * ROWS:(band + 1) * ROWS].tobytes()):08x}"
+        for band in range(BANDS)
+    ]
+
+
+def estimated_similarity(signature, other):
+    return float(np.mean(signature == other))
+
+
+class ArchetypeIndex:
+    # Indice LSH em memoria usado pelo job offline; o mesmo algoritmo de
+    # atribuicao e usado no modo incremental consultando a colecao archetypes
+
+    def __init__(self):
+        self.archetypes = []
+        self.signatures = []
+        self.buckets = {}
+
+    def assign(self, cards, signature):
+        bands = band_keys(signature)
+        candidates = {index for band in bands for index in self.buckets.get(band, [])}
+        best, best_similarity = None, SIMILARITY_THRESHOLD
+        for index in candidates:
+            similarity = estimated_similarity(signature, self.signatures[index])
+            if similarity >= best_similarity:
+                best, best_similarity = index, similarity
+        if best is not None:
+            return self.archetypes[best]["_id"]
+
+        archetype = new_archetype(cards, signature, bands)
+        for band in bands:
+            self.buckets.setdefault(band, []).append(len(self.archetypes))
+        self.archetypes.append(archetype)
+        self.signatures.append(signature)
+        return archetype["_id"]
+
+
+def new_archetype(cards, signature, bands):
+    return {
+        "_id": hashlib.sha1(deck_key(cards).encode("utf-8")).hexdigest()[:16],
+        "deck": sorted(cards),
+        "signature": [int(value) for value in signature],
+        "bands": bands,
+    }
+
+
+def cluster_decks(db, batch_size=20000):
+    logging.info("Counting distinct decks...")
+    deck_counts = {}
+    deck_cards = {}
+    cursor = db["battles"].find({}, {"_id": 0, "winner.cards": 1, "loser.cards": 1})
+    for battle in cursor:
+        for side in ("winner", "loser"):
+            cards = battle[side]["cards"]
+            if not cards:
+                continue
+            key = deck_key(cards)
+            deck_counts[key] = deck_counts.get(key, 0) + 1
+            deck_cards.setdefault(key, cards)
+    logging.info(f"Found {len(deck_counts)} distinct decks.")
+
+    # Os decks mais jogados viram os representantes dos arquetipos
+    keys = sorted(deck_counts, key=deck_counts.get, reverse=True)
+    index = ArchetypeIndex()
+    assignments = {}
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        signatures = minhash_signatures([deck_cards[key] for key in batch])
+        for key, signature in zip(batch, signatures):
+            assignments[key] = index.assign(deck_cards[key], signature)
+    logging.info(f"Clustered decks into {len(index.archetypes)} archetypes.")
+
+    db["archetypes"].delete_many({})
+    db["deck_archetypes"].delete_many({})
+    for start in range(0, len(index.archetypes), batch_size):
+        db["archetypes"].insert_many(index.archetypes[start:start + batch_size])
+    for start in range(0, len(keys), batch_size):
+        db["deck_archetypes"].insert_many(
+            [{"_id": key, "archetype": assignments[key]} for key in keys[start:start + batch_size]]
+        )
+    db["archetypes"].create_index("bands")
+
+    _ARCHETYPE_CACHE.clear()
+    _ARCHETYPE_CACHE.update(assignments)
+    return assignments
+
+
+def backfill_battle_archetypes(db, assignments, batch_size=1000):
+    logging.info("Backfilling battle archetypes...")
+    operations = []
+    updated = 0
+    cursor = db["battles"].find(
+        {},
+        {
+            "winner.cards": 1,
+            "loser.cards": 1,
+            "winner.archetype": 1,
+            "loser.archetype": 1,
+        },
+    )
+    for battle in cursor:
+        changes = {}
+        for side in ("winner", "loser"):
+            key = deck_key(battle[side]["cards"])
+            archetype = assignments.get(key)
+            if battle[side].get("archetype") != archetype:
+                changes[f"{side}.archetype"] = archetype
+        if changes:
+            operations.append(UpdateOne({"_id": battle["_id"]}, {"$set": changes}))
+        if len(operations) >= batch_size:
+            db["battles"].bulk_write(operations, ordered=False)
+            updated += len(operations)
+            operations = []
+    if operations:
+        db["battles"].bulk_write(operations, ordered=False)
+        updated += len(operations)
+    logging.info(f"Updated archetypes of {updated} battles.")
+
+
+def assign_archetypes(db, decks):
+    # Atribui os arquetipos de um lote de decks com poucas idas ao banco: uma
+    # consulta $in em deck_archetypes, as assinaturas MinHash calculadas de uma
+    # vez e uma consulta $in pelas bandas dos decks novos. Os decks novos sao
+    # agrupados entre si no mesmo indice em memoria, como no job offline
+    assignments = {}
+    missing = {}
+    for cards in decks:
+        if not cards:
+            continue
+        key = deck_key(cards)
+        if key in _ARCHETYPE_CACHE:
+            assignments[key] = _ARCHETYPE_CACHE[key]
+        else:
+            missing.setdefault(key, cards)
+    if not missing:
+        return assignments
+
+    for assigned in db["deck_archetypes"].find({"_id": {"$in": list(missing)}}):
+        assignments[assigned["_id"]] = assigned["archetype"]
+        missing.pop(assigned["_id"])
+    if missing:
+        keys = list(missing)
+        signatures = minhash_signatures([missing[key] for key in keys])
+        bands = {band for signature in signatures for band in band_keys(signature)}
+
+        # Indice com os arquetipos existentes que compartilham alguma banda
+        index = ArchetypeIndex()
+        for candidate in db["archetypes"].find(
+            {"bands": {"$in": list(bands)}}, {"signature": 1, "bands": 1}
+        ):
+            for band in candidate["bands"]:
+                index.buckets.setdefault(band, []).append(len(index.archetypes))
+            index.archetypes.append({"_id": candidate["_id"]})
+            index.signatures.append(np.array(candidate["signature"], dtype=np.uint64))
+        existing = len(index.archetypes)
+
+        for key, signature in zip(keys, signatures):
+            assignments[key] = index.assign(missing[key], signature)
+
+        new_archetypes = index.archetypes[existing:]
+        if new_archetypes:
+            db["archetypes"].bulk_write(
+                [
+                    UpdateOne(
+                        {"_id": archetype["_id"]},
+                        {
+                            "$setOnInsert": {
+                                field: value for field, value in archetype.items() if field != "_id"
+                            }
+                        },
+                        upsert=True,
+                    )
+                    for archetype in new_archetypes
+                ],
+                ordered=False,
+            )
+        db["deck_archetypes"].bulk_write(
+            [
+                UpdateOne({"_id": key}, {"$set": {"archetype": assignments[key]}}, upsert=True)
+                for key in keys
+            ],
+            ordered=False,
+        )
+
+    _ARCHETYPE_CACHE.update(assignments)
+    return assignments
+
+
+def assign_archetype(db, card_ids):
+    if not card_ids:
+        return None
+    return assign_archetypes(db, [card_ids])[deck_key(card_ids)]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Deck archetype clustering with MinHash/LSH")
+    parser.add_argument(
+        "--skip-backfill", action="store_true", help="do not rewrite the archetype of stored battles"
+    )
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))["clash_royale"]
+    assignments = cluster_decks(db)
+    if not args.skip_backfill:
+        backfill_battle_archetypes(db, assignments)
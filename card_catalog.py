@@ -0,0 +1,189 @@
+import argparse
+import logging
+import os
+
+import pymongo
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+from archetypes import backfill_battle_archetypes, cluster_decks
+
+# Catalogo ja carregado no processo (um por banco)
+_CATALOGS = {}
+
+
+class CardCatalog:
+    # Tabelas em memoria para traduzir nome <-> id <-> indice denso em O(1).
+    # Quando uma carta nao e encontrada o catalogo e recarregado do banco uma
+    # vez, cobrindo cartas novas registradas pelo coletor.
+
+    def __init__(self, db):
+        self.db = db
+        self.refresh()
+
+    def refresh(self):
+        cards = list(self.db["cards"].find({}).sort("_id", 1))
+        self.cards = cards
+        self.ids = [card["_id"] for card in cards]
+        self.names = [card["name"] for card in cards]
+        self.index_by_id = {card_id: index for index, card_id in enumerate(self.ids)}
+        self.id_by_name = {card["name"]: card["_id"] for card in cards}
+        self.name_by_id = {card["_id"]: card["name"] for card in cards}
+        logging.debug(f"Loaded card catalog with {len(cards)} cards.")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def id_of(self, name):
+        if name not in self.id_by_name:
+            self.refresh()
+        return self.id_by_name.get(name)
+
+    def ids_of(self, names):
+        return [self.id_of(name) for name in names]
+
+    def name_of(self, card_id):
+        if card_id not in self.name_by_id:
+            self.refresh()
+        return self.name_by_id.get(card_id, str(card_id))
+
+    def names_of(self, card_ids):
+        return [self.name_of(card_id) for card_id in card_ids]
+
+    def index_of(self, card_id):
+        if card_id not in self.index_by_id:
+            self.refresh()
+        return self.index_by_id.get(card_id)
+
+
+def load_card_catalog(db, reload=False):
+    catalog = _CATALOGS.get(db.name)
+    if catalog is None or reload or catalog.db is not db:
+        catalog = _CATALOGS[db.name] = CardCatalog(db)
+    return catalog
+
+
+def catalog_record(card):
+    return {
+        "name": card["name"],
+        "elixir": card.get("elixirCost"),
+        "rarity": card.get("rarity"),
+        "maxLevel": card.get("maxLevel"),
+    }
+
+
+def upsert_cards(db, cards):
+    # Aceita tanto a lista de /cards da API quanto as cartas embutidas nos decks
+    operations = [
+        UpdateOne({"_id": card["id"]}, {"$set": catalog_record(card)}, upsert=True)
+        for card in cards
+    ]
+    if operations:
+        db["cards"].bulk_write(operations, ordered=False)
+    logging.debug(f"Upserted {len(operations)} cards into the catalog.")
+
+
+def register_cards(db, cards):
+    # Registra apenas as cartas que ainda nao estao no catalogo do processo
+    catalog = load_card_catalog(db)
+    unseen = {card["id"]: card for card in cards if card["id"] not in catalog.name_by_id}
+    if unseen:
+        upsert_cards(db, list(unseen.values()))
+        catalog.refresh()
+
+
+def compact_deck(cards):
+    # Deck compacto: ids inteiros na ordem do deck. Comparacoes de decks
+    # ordenam os ids na hora (deck_key, $sortArray), a ordem gravada e a usada
+    # pelos combos
+    return [card["id"] for card in cards]
+
+
+def sync_from_observed(db):
+    # Popula o catalogo a partir das cartas ja gravadas nos decks antigos
+    for collection, fields in (
+        ("battles", ["$winner.deck", "$loser.deck"]),
+        ("players", ["$deck"]),
+    ):
+        pipeline = [
+            {
+                "$project": {
+                    "cards": {"$concatArrays": [{"$ifNull": [field, []]} for field in fields]}
+                }
+            },
+            {"$unwind": "$cards"},
+            {
+                "$group": {
+                    "_id": "$cards.id",
+                    "name": {"$first": "$cards.name"},
+                    "elixirCost": {"$first": "$cards.elixirCost"},
+                    "rarity": {"$first": "$cards.rarity"},
+                    "maxLevel": {"$first": "$cards.maxLevel"},
+                }
+            },
+        ]
+        cards = [dict(card, id=card["_id"]) for card in db[collection].aggregate(pipeline)]
+        upsert_cards(db, cards)
+    load_card_catalog(db, reload=True)
+
+
+def compact_collections(db, batch_size=1000):
+    # Converte os decks completos gravados antes do catalogo para ids compactos
+    for collection, sides in (("battles", ["winner", "loser"]), ("players", [None])):
+        operations = []
+        converted = 0
+        fields = [f"{side}.deck" if side else "deck" for side in sides]
+        cursor = db[collection].find(
+            {"$or": [{field: {"$exists": True}} for field in fields]},
+            {field: 1 for field in fields},
+        )
+        for document in cursor:
+            changes = {}
+            removed = {}
+            for side, field in zip(sides, fields):
+                deck = document.get(side, {}).get("deck") if side else document.get("deck")
+                if deck is None:
+                    continue
+                changes[f"{side}.cards" if side else "cards"] = compact_deck(deck)
+                removed[field] = ""
+            operations.append(
+                UpdateOne({"_id": document["_id"]}, {"$set": changes, "$unset": removed})
+            )
+            if len(operations) >= batch_size:
+                db[collection].bulk_write(operations, ordered=False)
+                converted += len(operations)
+                operations = []
+        if operations:
+            db[collection].bulk_write(operations, ordered=False)
+            converted += len(operations)
+        logging.info(f"Compacted decks of {converted} documents in {collection}.")
+
+
+def rebuild_derived(db):
+    # Dados derivados gravados com nomes de cartas deixam de bater com os ids:
+    # as matrizes de confronto sao descartadas (reconstruidas no proximo build
+    # ou consulta) e os arquetipos sao reagrupados a partir dos decks compactos
+    removed = db["matchup_matrices"].delete_many({}).deleted_count
+    logging.info(f"Dropped {removed} matchup matrices built from card names.")
+    backfill_battle_archetypes(db, cluster_decks(db))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Card catalog maintenance")
+    parser.add_argument(
+        "command",
+        choices=["sync", "compact"],
+        help="sync: populate the catalog from the stored decks; "
+        "compact: replace embedded decks with card ids and rebuild the matchup "
+        "matrices and archetypes",
+    )
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))["clash_royale"]
+    sync_from_observed(db)
+    if args.command == "compact":
+        compact_collections(db)
+        rebuild_derived(db)
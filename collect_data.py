@@ -2,16 +2,21 @@ import requests
 import pymongo
 import os
 import logging
+import time
 from dotenv import load_dotenv
-from datetime import datetime
 from urllib.parse import quote
-
-# Configurar logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+from card_catalog import register_cards, upsert_cards
+from collector_metrics import METRICS
+from records import battle_record, ingest_fields, player_record
+from rollups import next_sequence
 
 # Carregar variáveis de ambiente do arquivo .env
 load_dotenv()
 
+# Configurar logging; as mensagens por requisicao e por gravacao sao DEBUG e o
+# acompanhamento normal fica no resumo periodico de collector_metrics
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s - %(levelname)s - %(message)s')
+
 # Configurações da API e MongoDB
 API_KEY = os.getenv('API_KEY')
 BASE_URL = 'https://api.clashroyale.com/v1'
@@ -21,10 +26,28 @@ DB_NAME = 'clash_royale'
 CLIENT = pymongo.MongoClient(MONGO_URI)
 DB = CLIENT[DB_NAME]
 
+def api_get(endpoint, url):
+    started = time.monotonic()
+    response = requests.get(url, headers=HEADERS)
+    METRICS.observe_request(endpoint, response.status_code, time.monotonic() - started)
+    return response
+
+def get_cards():
+    logging.debug("Fetching cards...")
+    url = f'{BASE_URL}/cards'
+    response = api_get('cards', url)
+    if response.status_code == 200:
+        cards = response.json().get('items', [])
+        logging.debug(f"Fetched {len(cards)} cards.")
+        return cards
+    else:
+        logging.error(f"Failed to fetch cards: {response.status_code} - {response.text}")
+        return []
+
 def get_clan(clan_name):
     logging.debug("Fetching clans...")
     url = f'{BASE_URL}/clans?name={clan_name}&minMembers=10&limit=10'
-    response = requests.get(url, headers=HEADERS)
+    response = api_get('clans', url)
     if response.status_code == 200:
         clans = response.json().get('items', [])
         logging.debug(f"Fetched {len(clans)} clans.")
@@ -37,7 +60,7 @@ def get_clan_members(clan_tag):
     logging.debug(f"Fetching members for clan {clan_tag}...")
     encoded_clan_tag = quote(clan_tag)
     url = f'{BASE_URL}/clans/{encoded_clan_tag}/members'
-    response = requests.get(url, headers=HEADERS)
+    response = api_get('clan_members', url)
     if response.status_code == 200:
         members = response.json().get('items', [])
         logging.debug(f"Fetched {len(members)} members for clan {clan_tag}.")
@@ -50,7 +73,7 @@ def get_player_data(player_tag):
     logging.debug(f"Fetching data for player {player_tag}...")
     encoded_player_tag = quote(player_tag)
     url = f'{BASE_URL}/players/{encoded_player_tag}'
-    response = requests.get(url, headers=HEADERS)
+    response = api_get('players', url)
     if response.status_code == 200:
         player_data = response.json()
         logging.debug(f"Fetched data for player {player_tag}.")
@@ -67,19 +90,10 @@ def save_player_data(player_data):
         saved = len(player[0]) != 0 
       
         if not saved:
-            player_record = {
-                'tag': player_data['tag'],
-                'name': player_data['name'],
-                'expLevel': player_data['expLevel'],
-                'trophies': player_data['trophies'],
-                'bestTrophies': player_data['bestTrophies'],
-                'wins': player_data['wins'],
-                'losses': player_data['losses'],
-                'battleCount': player_data['battleCount'],
-                'threeCrownWins': player_data['threeCrownWins'],
-                'deck': player_data['currentDeck']
-            }
-            result = collection.update_one({'tag': player_data['tag']}, {'$set': player_record}, upsert=True)
+            register_cards(DB, player_data['currentDeck'])
+            started = time.monotonic()
+            result = collection.update_one({'tag': player_data['tag']}, {'$set': player_record(player_data)}, upsert=True)
+            METRICS.observe_write('players', time.monotonic() - started, players=1)
             logging.debug(f"Saved data for player {player_data['tag']}.")
             logging.debug(f"Player id is {result.upserted_id}.")
             return result.upserted_id
@@ -91,7 +105,7 @@ def get_battle_logs(player_tag):
     logging.debug(f"Fetching battle logs for player {player_tag}...")
     encoded_player_tag = quote(player_tag)
     url = f'{BASE_URL}/players/{encoded_player_tag}/battlelog'
-    response = requests.get(url, headers=HEADERS)
+    response = api_get('battlelog', url)
     if response.status_code == 200:
         battle_logs = response.json()
         logging.debug(f"Fetched {len(battle_logs)} battle logs for player {player_tag}.")
@@ -119,33 +133,20 @@ def save_battle_logs(battle_logs, player_tag, player_id):
         else:
             log['opponent'][0]["mongoId"] = opponent_mongo_data[0][0]["_id"]
             
-        winner = {}
-        loser = {}
-        if log['team'][0]['crowns'] > log['opponent'][0]['crowns']: 
-            winner = log['team'][0]
-            loser = log['opponent'][0]
-        else: 
-            winner = log['opponent'][0]
-            loser = log['team'][0]
-
-        battle_record = {
-            'battleTime': log['battleTime'],
-            'winner': {
-                "playerId": winner["mongoId"],
-                "tag": winner['tag'],
-                "name": winner['name'],
-                "deck": winner['cards'],
-                "crowns": winner['crowns'],
-            },
-            'loser': {
-                "playerId": loser["mongoId"],
-                "tag": loser['tag'],
-                "name": loser['name'],
-                "deck": loser['cards'],
-                "crowns": loser['crowns'],
-            },
-        }
-        collection.update_one({'battleTime': log['battleTime'], 'mainPlayerTag': player_tag}, {'$set': battle_record}, upsert=True)
+        register_cards(DB, log['team'][0]['cards'] + log['opponent'][0]['cards'])
+        record = battle_record(DB, log)
+        # A sequencia do consumidor de rollups e reservada logo antes da
+        # gravacao (depois das chamadas da API do oponente), para que nenhum
+        # outro gravador passe na frente de uma sequencia ainda nao gravada;
+        # batalhas ja gravadas mantem a sequencia original
+        seq = next_sequence(DB, 'battles')
+        started = time.monotonic()
+        collection.update_one(
+            {'battleTime': log['battleTime'], 'mainPlayerTag': player_tag},
+            {'$set': record, '$setOnInsert': ingest_fields(seq)},
+            upsert=True,
+        )
+        METRICS.observe_write('battles', time.monotonic() - started, battles=1)
     logging.debug(f"Saved battle logs for player {player_tag}.")
 
 def dataRemover():
@@ -158,7 +159,9 @@ def dataRemover():
 
 
 if __name__ == '__main__':
-    logging.debug("Starting data collection process...")
+    logging.info("Starting data collection process...")
+    METRICS.start()
+    upsert_cards(DB, get_cards())
 
     clans = [
         # 'WHAM! RO',
@@ -174,7 +177,7 @@ if __name__ == '__main__':
     ]
 
     for clanName in clans:
-        logging.debug(f"----------- Clan {clanName} -----------------")
+        logging.info(f"----------- Clan {clanName} -----------------")
         clan = get_clan(clanName)
         player_tags = []
         for atributte in clan:
@@ -183,7 +186,7 @@ if __name__ == '__main__':
             for member in members:
                 player_tags.append(member['tag'])
         
-        logging.debug(f"Collected {len(player_tags)} player tags.")
+        logging.info(f"Collected {len(player_tags)} player tags.")
         
         for player_tag in player_tags:
             player_data = get_player_data(player_tag)
@@ -191,4 +194,5 @@ if __name__ == '__main__':
             battle_logs = get_battle_logs(player_tag)
             save_battle_logs(battle_logs, player_tag, playerId)
     
-    logging.debug("Data collection process completed.")
+    logging.info(METRICS.summary())
+    logging.info("Data collection process completed.")
@@ -0,0 +1,169 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+# Intervalo (segundos) da linha de resumo do coletor
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "30"))
+# Porta do exporter Prometheus (desligado quando vazio)
+METRICS_PORT = os.getenv("METRICS_PORT")
+# Limite de requisicoes por segundo da chave da API, usado na estimativa de
+# quota restante (0 = desconhecido)
+API_RATE_LIMIT = float(os.getenv("API_RATE_LIMIT", "0"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    # Contagem por faixa de latencia; os percentis sao o limite superior da
+    # faixa onde caem, precisao suficiente para o resumo
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[position] if position < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class CollectorMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = {}
+        self.latency = {}
+        self.throttled = 0
+        self.errors = 0
+        self.battles = 0
+        self.players = 0
+        self.db_writes = {}
+        self.recent_requests = deque()
+        self.last_report = (self.started, 0, 0)
+        self.prometheus = None
+
+    def observe_request(self, endpoint, status, seconds):
+        now = time.monotonic()
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.latency.setdefault(endpoint, Histogram()).observe(seconds)
+            self.throttled += status == 429
+            self.errors += status != 200
+            self.recent_requests.append(now)
+            quota = self.quota_remaining()
+        if self.prometheus:
+            self.prometheus["requests"].labels(endpoint, str(status)).inc()
+            self.prometheus["latency"].labels(endpoint).observe(seconds)
+            if quota is not None:
+                self.prometheus["quota"].set(quota)
+
+    def observe_write(self, collection, seconds, battles=0, players=0):
+        with self.lock:
+            self.db_writes.setdefault(collection, Histogram()).observe(seconds)
+            self.battles += battles
+            self.players += players
+        if self.prometheus:
+            self.prometheus["writes"].labels(collection).observe(seconds)
+            if battles:
+                self.prometheus["battles"].inc(battles)
+
+    def quota_remaining(self):
+        # Requisicoes ainda disponiveis no segundo corrente (chamado com o lock)
+        if not API_RATE_LIMIT:
+            return None
+        cutoff = time.monotonic() - 1
+        while self.recent_requests and self.recent_requests[0] < cutoff:
+            self.recent_requests.popleft()
+        return max(0.0, API_RATE_LIMIT - len(self.recent_requests))
+
+    def summary(self):
+        now = time.monotonic()
+        with self.lock:
+            total_requests = sum(self.requests.values())
+            last_time, last_requests, last_battles = self.last_report
+            elapsed = max(now - last_time, 1e-9)
+            request_rate = (total_requests - last_requests) / elapsed
+            battle_rate = (self.battles - last_battles) / elapsed
+            self.last_report = (now, total_requests, self.battles)
+            latencies = ", ".join(
+                f"{endpoint} p50={histogram.percentile(0.5) * 1000:.0f}ms "
+                f"p95={histogram.percentile(0.95) * 1000:.0f}ms"
+                for endpoint, histogram in sorted(self.latency.items())
+            )
+            writes = ", ".join(
+                f"{collection} p95={histogram.percentile(0.95) * 1000:.0f}ms"
+                for collection, histogram in sorted(self.db_writes.items())
+            )
+            quota = self.quota_remaining()
+            return (
+                f"API {request_rate:.1f} req/s ({total_requests} total, {self.errors} errors, "
+                f"{self.throttled} throttled"
+                + (f", ~{quota:.0f} req/s left" if quota is not None else "")
+                + f") [{latencies}] | ingest {battle_rate:.1f} battles/s "
+                f"({self.battles} battles, {self.players} players) | DB writes [{writes}]"
+            )
+
+    def start_prometheus(self, port):
+        if prometheus_client is None:
+            logging.warning("prometheus_client is not installed, the metrics exporter is disabled.")
+            return
+        self.prometheus = {
+            "requests": prometheus_client.Counter(
+                "clash_api_requests_total", "Clash Royale API requests", ["endpoint", "status"]
+            ),
+            "latency": prometheus_client.Histogram(
+                "clash_api_request_seconds",
+                "Clash Royale API latency",
+                ["endpoint"],
+                buckets=LATENCY_BUCKETS,
+            ),
+            "quota": prometheus_client.Gauge(
+                "clash_api_quota_remaining", "Estimated API requests left in the current second"
+            ),
+            "battles": prometheus_client.Counter(
+                "clash_battles_ingested_total", "Battles written by the collector"
+            ),
+            "writes": prometheus_client.Histogram(
+                "clash_db_write_seconds",
+                "MongoDB write latency",
+                ["collection"],
+                buckets=LATENCY_BUCKETS,
+            ),
+        }
+        prometheus_client.start_http_server(int(port))
+        logging.info(f"Prometheus metrics exposed on port {port}.")
+
+    def start(self, interval=METRICS_INTERVAL, port=METRICS_PORT):
+        if port:
+            self.start_prometheus(port)
+
+        def report():
+            while True:
+                time.sleep(interval)
+                logging.info(self.summary())
+
+        threading.Thread(target=report, name="collector-metrics", daemon=True).start()
+
+
+METRICS = CollectorMetrics()
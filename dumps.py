@@ -0,0 +1,283 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+import pymongo
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+from archetypes import assign_archetypes, deck_key
+from card_catalog import load_card_catalog, register_cards
+from records import battle_record, ingest_fields, player_record
+from rollups import next_sequence
+
+BATCH_SIZE = 1000
+MAX_IN_FLIGHT = 4
+PLAYER_FIELDS = [
+    "tag",
+    "name",
+    "expLevel",
+    "trophies",
+    "bestTrophies",
+    "wins",
+    "losses",
+    "battleCount",
+    "threeCrownWins",
+]
+
+
+def open_dump(path, mode="rt"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class BulkWriter:
+    # Grava os lotes em segundo plano com no maximo max_in_flight lotes
+    # pendentes; a leitura do arquivo espera quando o limite e atingido, entao
+    # a memoria usada nao depende do tamanho do dump.
+    # Os lotes de batalhas passam por uma unica thread, que reserva o ingestSeq
+    # so na hora de gravar e grava em ordem (ordered=True): as batalhas ja
+    # gravadas sempre formam um prefixo das sequencias reservadas, e o
+    # consumidor de rollups nunca passa o checkpoint por cima de uma batalha
+    # que ainda vai ser gravada
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_in_flight)
+        self.battle_executor = ThreadPoolExecutor(1)
+        self.pending = set()
+        self.written = 0
+
+    @staticmethod
+    def write(collection, operations):
+        collection.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    @staticmethod
+    def write_battles(db, records):
+        first_seq = next_sequence(db, "battles", len(records))
+        operations = [
+            UpdateOne(
+                battle_filter,
+                {"$set": record, "$setOnInsert": ingest_fields(first_seq + position)},
+                upsert=True,
+            )
+            for position, (battle_filter, record) in enumerate(records)
+        ]
+        db["battles"].bulk_write(operations, ordered=True)
+        return len(operations)
+
+    def collect(self, done):
+        for future in done:
+            self.written += future.result()
+
+    def wait_slot(self):
+        if len(self.pending) >= self.max_in_flight:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            self.collect(done)
+
+    def submit(self, collection, operations):
+        self.wait_slot()
+        self.pending.add(self.executor.submit(self.write, collection, operations))
+
+    def submit_battles(self, db, records):
+        self.wait_slot()
+        self.pending.add(self.battle_executor.submit(self.write_battles, db, records))
+
+    def drain(self):
+        self.collect(wait(self.pending).done)
+        self.pending = set()
+
+    def close(self):
+        self.drain()
+        self.executor.shutdown()
+        self.battle_executor.shutdown()
+
+
+def player_operations(db, players):
+    operations = []
+    for player_data in players:
+        register_cards(db, player_data["currentDeck"])
+        operations.append(
+            UpdateOne(
+                {"tag": player_data["tag"]}, {"$set": player_record(player_data)}, upsert=True
+            )
+        )
+    return operations
+
+
+def battle_records(db, logs, classify=True):
+    # Resolve o _id dos jogadores do lote em uma unica consulta pelo indice de tag
+    tags = {side["tag"] for log in logs for side in (log["team"][0], log["opponent"][0])}
+    player_ids = {
+        player["tag"]: player["_id"]
+        for player in db["players"].find({"tag": {"$in": list(tags)}}, {"tag": 1})
+    }
+    records = []
+    for log in logs:
+        for side in (log["team"][0], log["opponent"][0]):
+            side["mongoId"] = player_ids.get(side["tag"])
+        register_cards(db, log["team"][0]["cards"] + log["opponent"][0]["cards"])
+        records.append(
+            (
+                {"battleTime": log["battleTime"], "mainPlayerTag": log["team"][0]["tag"]},
+                battle_record(db, log, classify=False),
+            )
+        )
+
+    if classify:
+        # Arquetipos do lote inteiro de uma vez, em vez de um deck por vez
+        sides = [record[side] for _, record in records for side in ("winner", "loser")]
+        archetypes = assign_archetypes(db, [side["cards"] for side in sides])
+        for side in sides:
+            side["archetype"] = archetypes.get(deck_key(side["cards"])) if side["cards"] else None
+    return records
+
+
+def import_dumps(db, paths, batch_size=BATCH_SIZE, max_in_flight=MAX_IN_FLIGHT, classify=True):
+    # Cada linha e um battlelog (tem battleTime) ou um jogador da API de perfis
+    db["battles"].create_index([("battleTime", 1), ("mainPlayerTag", 1)])
+    db["players"].create_index("tag")
+    started = time.monotonic()
+    writer = BulkWriter(max_in_flight)
+    players, logs = [], []
+    players_pending = False
+    read = 0
+
+    def flush_players():
+        nonlocal players, players_pending
+        if players:
+            writer.submit(db["players"], player_operations(db, players))
+            players = []
+            players_pending = True
+
+    def flush_battles():
+        nonlocal logs, players_pending
+        # Os jogadores precisam estar gravados para as batalhas receberem o
+        # playerId, inclusive os que ainda nao completaram um lote
+        flush_players()
+        if players_pending:
+            writer.drain()
+            players_pending = False
+        writer.submit_battles(db, battle_records(db, logs, classify))
+        logs = []
+
+    for path in paths:
+        logging.info(f"Importing {path}...")
+        with open_dump(path) as dump:
+            for line in dump:
+                if not line.strip():
+                    continue
+                document = json.loads(line)
+                read += 1
+                if "battleTime" in document:
+                    logs.append(document)
+                    if len(logs) >= batch_size:
+                        flush_battles()
+                else:
+                    players.append(document)
+                    if len(players) >= batch_size:
+                        flush_players()
+                if read % 100000 == 0:
+                    rate = read / (time.monotonic() - started)
+                    logging.info(f"Read {read} documents ({rate:.0f}/s).")
+    flush_players()
+    if logs:
+        flush_battles()
+    writer.close()
+    logging.info(
+        f"Imported {writer.written} documents from {len(paths)} files "
+        f"in {time.monotonic() - started:.1f}s."
+    )
+    return writer.written
+
+
+def export_card(catalog, card_id):
+    card = catalog.cards[catalog.index_of(card_id)]
+    return {
+        "id": card_id,
+        "name": card["name"],
+        "elixirCost": card.get("elixir"),
+        "rarity": card.get("rarity"),
+        "maxLevel": card.get("maxLevel"),
+    }
+
+
+def export_side(catalog, side):
+    # Campos derivados na importacao (playerId, archetype) nao sao exportados
+    exported = {
+        field: value
+        for field, value in side.items()
+        if field not in ("playerId", "archetype", "cards")
+    }
+    exported["cards"] = [export_card(catalog, card_id) for card_id in side.get("cards", [])]
+    return exported
+
+
+def export_dump(db, path, start_time=None, end_time=None):
+    # Gera o mesmo formato aceito pela importacao: jogadores primeiro e depois
+    # os battlelogs do ponto de vista do jogador principal (team)
+    catalog = load_card_catalog(db, reload=True)
+    battle_time = {}
+    if start_time:
+        battle_time["$gte"] = datetime.strptime(start_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+    if end_time:
+        battle_time["$lt"] = datetime.strptime(end_time, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+    match = {"battleTime": battle_time} if battle_time else {}
+
+    exported = 0
+    with open_dump(path, "wt") as dump:
+        for player in db["players"].find({}, {"_id": 0}, batch_size=10000):
+            player_data = {field: player.get(field) for field in PLAYER_FIELDS}
+            player_data["currentDeck"] = [
+                export_card(catalog, card_id) for card_id in player.get("cards", [])
+            ]
+            dump.write(json.dumps(player_data) + "\n")
+            exported += 1
+        for battle in db["battles"].find(match, {"_id": 0}, batch_size=10000).sort("battleTime", 1):
+            team, opponent = battle["winner"], battle["loser"]
+            if battle.get("mainPlayerTag", team["tag"]) != team["tag"]:
+                team, opponent = opponent, team
+            log = {
+                "battleTime": battle["battleTime"],
+                "team": [export_side(catalog, team)],
+                "opponent": [export_side(catalog, opponent)],
+            }
+            dump.write(json.dumps(log) + "\n")
+            exported += 1
+    logging.info(f"Exported {exported} documents to {path}.")
+    return exported
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Import and export newline-delimited battlelog dumps")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="load .ndjson or .ndjson.gz dumps")
+    import_parser.add_argument("paths", nargs="+")
+    import_parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    import_parser.add_argument("--workers", type=int, default=MAX_IN_FLIGHT, help="bulk writes in flight")
+    import_parser.add_argument(
+        "--skip-archetypes",
+        action="store_true",
+        help="leave the archetype empty and run archetypes.py after the import",
+    )
+    export_parser = subparsers.add_parser("export", help="write players and battles to a dump")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--start", help="YYYY-MM-DD")
+    export_parser.add_argument("--end", help="YYYY-MM-DD")
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))["clash_royale"]
+    if args.command == "import":
+        import_dumps(db, args.paths, args.batch_size, args.workers, not args.skip_archetypes)
+    else:
+        export_dump(db, args.path, args.start, args.end)
@@ -0,0 +1,22 @@
+import multiprocessing
+import os
+
+# Configuracao do gunicorn para servir o wsgi:app com varios workers
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# Cada worker atende varias requisicoes em threads; o pool de conexoes do
+# Mongo (MONGO_MAX_POOL_SIZE) deve ser maior ou igual a esse valor
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+# Carrega o app uma vez no mestre; o cliente do Mongo e recriado em cada worker
+preload_app = True
+accesslog = os.getenv("GUNICORN_ACCESS_LOG")
+
+
+def post_fork(server, worker):
+    import app
+
+    app.reset_client()
+    app.warm_up()
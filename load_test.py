@@ -0,0 +1,79 @@
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Teste de carga simples: dispara N requisicoes para cada nivel de concorrencia
+# e mostra como a vazao e a latencia escalam com o numero de clientes.
+
+_LOCAL = threading.local()
+
+
+def session():
+    if not hasattr(_LOCAL, "session"):
+        _LOCAL.session = requests.Session()
+    return _LOCAL.session
+
+
+def send(url, endpoint, form):
+    started = time.perf_counter()
+    try:
+        if endpoint == "/":
+            response = session().get(url + endpoint, timeout=120)
+        else:
+            response = session().post(url + endpoint, data=form, timeout=120)
+        ok = response.status_code == 200
+    except requests.RequestException:
+        ok = False
+    return time.perf_counter() - started, ok
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_level(url, endpoint, form, concurrency, total_requests):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(
+            executor.map(lambda _: send(url, endpoint, form), range(total_requests))
+        )
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, ok in results if not ok)
+    print(
+        f"{concurrency:>11} {total_requests / elapsed:>10.1f} "
+        f"{statistics.median(latencies) * 1000:>9.1f} "
+        f"{percentile(latencies, 0.95) * 1000:>9.1f} "
+        f"{percentile(latencies, 0.99) * 1000:>9.1f} {errors:>7}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for the Flask dashboard")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--endpoint", default="/victory_percentage")
+    parser.add_argument(
+        "--form",
+        action="append",
+        default=[],
+        help="form field sent on POST endpoints as key=value (repeatable)",
+    )
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32")
+    parser.add_argument("--requests", type=int, default=200, help="requests per level")
+    args = parser.parse_args()
+
+    form = dict(field.split("=", 1) for field in args.form) or {
+        "card_name": "Knight",
+        "start_time": "2024-07-01",
+        "end_time": "2024-08-01",
+    }
+
+    print(f"{args.endpoint} at {args.url}")
+    print("concurrency      req/s   p50(ms)   p95(ms)   p99(ms)  errors")
+    for concurrency in [int(level) for level in args.concurrency.split(",")]:
+        run_level(args.url, args.endpoint, form, concurrency, args.requests)
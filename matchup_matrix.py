@@ -0,0 +1,269 @@
+import argparse
+import logging
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pymongo
+from bson.binary import Binary
+from dotenv import load_dotenv
+
+from card_catalog import load_card_catalog
+from rollups import CHECKPOINT_ID, SETTLE_SECONDS
+
+# Matrizes ja carregadas na memoria, indexadas pelo periodo (start_iso, end_iso)
+_MATRIX_CACHE = {}
+
+
+def to_battle_time(date):
+    return datetime.strptime(date, "%Y-%m-%d").strftime("%Y%m%dT%H%M%S.000Z")
+
+
+def accumulate_matchups(counts, winner_rows, loser_rows, total_cards):
+    # Aumenta a matriz quando novas cartas aparecem no meio da leitura
+    if counts.shape[0] < total_cards:
+        grow = total_cards - counts.shape[0]
+        counts = np.pad(counts, ((0, grow), (0, grow)))
+
+    # Decks incompletos sao completados com um indice sentinela (total_cards)
+    # que fica na ultima linha/coluna e e descartado no final
+    width = max(len(row) for row in winner_rows + loser_rows)
+    winners = np.full((len(winner_rows), width), total_cards, dtype=np.int64)
+    losers = np.full((len(loser_rows), width), total_cards, dtype=np.int64)
+    for position, row in enumerate(winner_rows):
+        winners[position, : len(row)] = row
+    for position, row in enumerate(loser_rows):
+        losers[position, : len(row)] = row
+
+    # Cada batalha gera todos os pares (carta vencedora, carta perdedora),
+    # contados de uma vez com bincount sobre o indice achatado do par
+    size = total_cards + 1
+    pairs = (winners[:, :, None] * size + losers[:, None, :]).ravel()
+    chunk = np.bincount(pairs, minlength=size * size).reshape(size, size)
+    counts += chunk[:total_cards, :total_cards]
+    return counts
+
+
+def counted_sequence(db):
+    # Sequencia ate onde a matriz conta as batalhas: o checkpoint do consumidor
+    # de rollups, que so avanca sobre sequencias ja gravadas. Sem consumidor,
+    # usa a maior sequencia gravada ha mais de SETTLE_SECONDS
+    settled = datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)
+    checkpoint = db["rollup_checkpoints"].find_one({"_id": CHECKPOINT_ID})
+    if checkpoint is not None:
+        return checkpoint.get("seq", 0), settled
+    battle = db["battles"].find_one(
+        {"ingestedAt": {"$lte": settled}}, {"ingestSeq": 1}, sort=[("ingestSeq", -1)]
+    )
+    return (battle or {}).get("ingestSeq", 0), settled
+
+
+def build_matchup_matrix(db, start_time, end_time, chunk_size=50000, base=None):
+    # Sem base le todas as batalhas do periodo; com base (matriz ja gravada)
+    # soma apenas as batalhas gravadas depois da sequencia dela
+    start_iso = to_battle_time(start_time)
+    end_iso = to_battle_time(end_time)
+    seq, settled = counted_sequence(db)
+    match = {"battleTime": {"$gte": start_iso, "$lt": end_iso}}
+    if base is None:
+        logging.info(f"Building matchup matrix from {start_iso} to {end_iso}")
+        match["$or"] = [{"ingestSeq": {"$lte": seq}}, {"ingestSeq": {"$exists": False}}]
+        cards = []
+        counts = np.zeros((0, 0), dtype=np.int64)
+        total_battles = 0
+    else:
+        # A sequencia nunca volta (checkpoint criado depois do build, por exemplo)
+        seq = max(seq, base["seq"])
+        match["ingestSeq"] = {"$gt": base["seq"], "$lte": seq}
+        cards = list(base["cards"])
+        counts = base["counts"].copy()
+        total_battles = base["battles"]
+
+    card_index = {card_id: index for index, card_id in enumerate(cards)}
+    winner_rows = []
+    loser_rows = []
+
+    def index_of(card_id):
+        index = card_index.get(card_id)
+        if index is None:
+            index = card_index[card_id] = len(cards)
+            cards.append(card_id)
+        return index
+
+    # Le apenas os ids das cartas dos dois decks em uma unica passada
+    cursor = db["battles"].find(
+        match,
+        {"_id": 0, "winner.cards": 1, "loser.cards": 1},
+        batch_size=10000,
+    )
+    for battle in cursor:
+        winner_rows.append([index_of(card_id) for card_id in battle["winner"]["cards"]])
+        loser_rows.append([index_of(card_id) for card_id in battle["loser"]["cards"]])
+        total_battles += 1
+        if len(winner_rows) >= chunk_size:
+            counts = accumulate_matchups(counts, winner_rows, loser_rows, len(cards))
+            winner_rows, loser_rows = [], []
+    if winner_rows:
+        counts = accumulate_matchups(counts, winner_rows, loser_rows, len(cards))
+
+    if base is None:
+        logging.info(f"Matchup matrix built with {len(cards)} cards and {total_battles} battles")
+    else:
+        logging.debug(f"Matchup matrix refreshed to {total_battles} battles (seq {seq})")
+    return {
+        "startTime": start_iso,
+        "endTime": end_iso,
+        "cards": cards,
+        "battles": total_battles,
+        "counts": counts,
+        "seq": seq,
+        "builtAt": settled,
+    }
+
+
+def window_ended(matrix):
+    # O periodo ja tinha terminado quando a matriz foi montada
+    return matrix["endTime"] <= matrix["builtAt"].strftime("%Y%m%dT%H%M%S.000Z")
+
+
+def matrix_is_open(db, matrix):
+    # Periodo em aberto ou com batalhas gravadas depois da sequencia da matriz
+    # (consumidor atrasado ou battlelogs antigos coletados depois)
+    if not window_ended(matrix):
+        return True
+    pending = db["battles"].find_one(
+        {
+            "battleTime": {"$gte": matrix["startTime"], "$lt": matrix["endTime"]},
+            "ingestSeq": {"$gt": matrix["seq"]},
+        },
+        {"_id": 1},
+    )
+    return pending is not None
+
+
+def save_matchup_matrix(db, matrix):
+    # A matriz e armazenada densa (int64, linha = carta no deck vencedor,
+    # coluna = carta no deck perdedor) junto com a lista de ids por indice e
+    # a sequencia/horario ate onde as batalhas foram contadas
+    db["matchup_matrices"].replace_one(
+        {"_id": f"{matrix['startTime']}_{matrix['endTime']}"},
+        {
+            "startTime": matrix["startTime"],
+            "endTime": matrix["endTime"],
+            "cards": matrix["cards"],
+            "battles": matrix["battles"],
+            "counts": Binary(matrix["counts"].astype(np.int64).tobytes()),
+            "seq": matrix["seq"],
+            "builtAt": matrix["builtAt"],
+        },
+        upsert=True,
+    )
+    _MATRIX_CACHE[(matrix["startTime"], matrix["endTime"])] = matrix
+
+
+def load_matchup_matrix(db, start_time, end_time):
+    start_iso = to_battle_time(start_time)
+    end_iso = to_battle_time(end_time)
+    matrix = _MATRIX_CACHE.get((start_iso, end_iso))
+    if matrix is not None:
+        return matrix
+
+    document = db["matchup_matrices"].find_one({"_id": f"{start_iso}_{end_iso}"})
+    if document is None or "seq" not in document:
+        return None
+
+    total_cards = len(document["cards"])
+    matrix = {
+        "startTime": start_iso,
+        "endTime": end_iso,
+        "cards": document["cards"],
+        "battles": document["battles"],
+        "counts": np.frombuffer(document["counts"], dtype=np.int64).reshape(
+            total_cards, total_cards
+        ),
+        "seq": document["seq"],
+        "builtAt": document["builtAt"],
+    }
+    _MATRIX_CACHE[(start_iso, end_iso)] = matrix
+    return matrix
+
+
+def card_matchups(db, card_name, start_time, end_time, limit=5, min_games=20, build=True):
+    # Com build=False (rota do app) a matriz de um periodo novo nao e montada
+    # dentro da requisicao; periodos em aberto recebem so as batalhas novas
+    matrix = load_matchup_matrix(db, start_time, end_time)
+    if matrix is None:
+        if not build:
+            return {
+                "error": "No matchup matrix for this window yet, build it with "
+                f"python matchup_matrix.py build {start_time} {end_time}"
+            }
+        matrix = build_matchup_matrix(db, start_time, end_time)
+        save_matchup_matrix(db, matrix)
+    elif matrix_is_open(db, matrix):
+        refreshed = build_matchup_matrix(db, start_time, end_time, base=matrix)
+        if refreshed["seq"] != matrix["seq"] or window_ended(refreshed) != window_ended(matrix):
+            save_matchup_matrix(db, refreshed)
+        matrix = refreshed
+
+    catalog = load_card_catalog(db)
+    card_id = catalog.id_of(card_name)
+    if card_id not in matrix["cards"]:
+        return {}
+
+    counts = matrix["counts"]
+    index = matrix["cards"].index(card_id)
+    # Vitorias da carta contra cada oponente estao na linha da carta,
+    # derrotas estao na coluna
+    wins = counts[index, :]
+    losses = counts[:, index]
+    games = wins + losses
+
+    matchups = []
+    for opponent, opponent_id in enumerate(matrix["cards"]):
+        if opponent == index or games[opponent] < min_games:
+            continue
+        matchups.append(
+            {
+                "opponentCard": catalog.name_of(opponent_id),
+                "winRate": float(wins[opponent] / games[opponent] * 100),
+                "games": int(games[opponent]),
+            }
+        )
+
+    matchups.sort(key=lambda matchup: matchup["winRate"], reverse=True)
+    return {
+        "card": card_name,
+        "bestMatchups": matchups[:limit],
+        "worstMatchups": matchups[::-1][:limit],
+    }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Card vs card matchup matrix")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build and store the matrix of a window")
+    build_parser.add_argument("start_time", help="YYYY-MM-DD")
+    build_parser.add_argument("end_time", help="YYYY-MM-DD")
+    query_parser = subparsers.add_parser("query", help="best and worst matchups of a card")
+    query_parser.add_argument("card_name")
+    query_parser.add_argument("start_time", help="YYYY-MM-DD")
+    query_parser.add_argument("end_time", help="YYYY-MM-DD")
+    query_parser.add_argument("--limit", type=int, default=5)
+    query_parser.add_argument("--min-games", type=int, default=20)
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))["clash_royale"]
+    if args.command == "build":
+        save_matchup_matrix(db, build_matchup_matrix(db, args.start_time, args.end_time))
+    else:
+        result = card_matchups(
+            db, args.card_name, args.start_time, args.end_time, args.limit, args.min_games
+        )
+        for side in ("bestMatchups", "worstMatchups"):
+            print(side)
+            for matchup in result.get(side, []):
+                print(f"  {matchup['opponentCard']}: {matchup['winRate']:.2f}% in {matchup['games']} games")
@@ -0,0 +1,63 @@
+import random
+from datetime import datetime
+
+from archetypes import assign_archetype
+from card_catalog import compact_deck
+
+# Normalizacao dos jogadores e battlelogs da API nos documentos gravados,
+# compartilhada pelo coletor (collect_data.py) e pela importacao (dumps.py)
+
+
+def player_record(player_data):
+    return {
+        "tag": player_data["tag"],
+        "name": player_data["name"],
+        "expLevel": player_data["expLevel"],
+        "trophies": player_data["trophies"],
+        "bestTrophies": player_data["bestTrophies"],
+        "wins": player_data["wins"],
+        "losses": player_data["losses"],
+        "battleCount": player_data["battleCount"],
+        "threeCrownWins": player_data["threeCrownWins"],
+        "cards": compact_deck(player_data["currentDeck"]),
+    }
+
+
+def side_record(db, side, classify=True):
+    cards = compact_deck(side["cards"])
+    return {
+        "playerId": side.get("mongoId"),
+        "tag": side["tag"],
+        "name": side["name"],
+        "cards": cards,
+        "crowns": side["crowns"],
+        "startingTrophies": side.get("startingTrophies"),
+        "archetype": assign_archetype(db, cards) if classify else None,
+    }
+
+
+def battle_record(db, log, classify=True):
+    # Normaliza o battlelog da API em vencedor/perdedor; empate conta como
+    # vitoria do oponente
+    if log["team"][0]["crowns"] > log["opponent"][0]["crowns"]:
+        winner = log["team"][0]
+        loser = log["opponent"][0]
+    else:
+        winner = log["opponent"][0]
+        loser = log["team"][0]
+
+    return {
+        "battleTime": log["battleTime"],
+        "winner": side_record(db, winner, classify),
+        "loser": side_record(db, loser, classify),
+    }
+
+
+def ingest_fields(seq):
+    # Campos gravados apenas na insercao: sequencia do consumidor de rollups
+    # e chave da amostra do modo aproximado
+    return {
+        "ingestSeq": seq,
+        "ingestedAt": datetime.utcnow(),
+        "sampleKey": random.random(),
+    }
@@ -0,0 +1,165 @@
+import argparse
+import gzip
+import logging
+import os
+from datetime import datetime, timedelta
+
+import pymongo
+from bson import json_util
+from dotenv import load_dotenv
+from pymongo import ReplaceOne
+from pymongo.errors import OperationFailure
+
+from rollups import CHECKPOINT_ID
+
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "90"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+BATCH_SIZE = 5000
+
+
+def to_battle_time(day):
+    return day.strftime("%Y%m%dT%H%M%S.000Z")
+
+
+def archive_path(archive_dir, day):
+    return os.path.join(archive_dir, f"battles-{day.strftime('%Y%m%d')}.ndjson.gz")
+
+
+def day_match(day):
+    return {"battleTime": {"$gte": to_battle_time(day), "$lt": to_battle_time(day + timedelta(days=1))}}
+
+
+def rollups_cover(db, match):
+    # Uma batalha so pode sair da colecao depois de contada pelo consumidor de
+    # rollups, ou seja, com ingestSeq ate o checkpoint salvo
+    checkpoint = db["rollup_checkpoints"].find_one({"_id": CHECKPOINT_ID}) or {}
+    pending = db["battles"].find_one(
+        {
+            **match,
+            "restored": {"$ne": True},
+            "$or": [
+                {"ingestSeq": {"$exists": False}},
+                {"ingestSeq": {"$gt": checkpoint.get("seq", 0)}},
+            ],
+        },
+        {"_id": 1},
+    )
+    return pending is None
+
+
+def archive_day(db, day, archive_dir, batch_size=BATCH_SIZE):
+    match = day_match(day)
+    if not rollups_cover(db, match):
+        logging.warning(f"Rollups do not cover the battles of {day.date()} yet, keeping them.")
+        return 0
+
+    path = archive_path(archive_dir, day)
+    archived = 0
+    while True:
+        battles = list(db["battles"].find(match).sort("_id", 1).limit(batch_size))
+        if not battles:
+            break
+        # Batalhas restauradas ja estao no arquivo e sao apenas removidas;
+        # o arquivo e aberto em modo append (um membro gzip por lote) e so
+        # depois de fechado o lote e apagado da colecao
+        new_battles = [battle for battle in battles if not battle.get("restored")]
+        if new_battles:
+            with gzip.open(path, "at", encoding="utf-8") as archive:
+                for battle in new_battles:
+                    archive.write(json_util.dumps(battle) + "\n")
+        db["battles"].delete_many({"_id": {"$in": [battle["_id"] for battle in battles]}})
+        archived += len(new_battles)
+
+    if archived:
+        db["archives"].update_one(
+            {"_id": day.strftime("%Y%m%d")},
+            {
+                "$inc": {"battles": archived},
+                "$set": {"file": path, "archivedAt": datetime.utcnow()},
+            },
+            upsert=True,
+        )
+    logging.info(f"Archived {archived} battles of {day.date()} to {path}.")
+    return archived
+
+
+def archive_battles(db, retention_days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR, compact=False):
+    # Move as batalhas mais antigas que o horizonte para arquivos NDJSON
+    # comprimidos, um por dia
+    os.makedirs(archive_dir, exist_ok=True)
+    cutoff = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(
+        days=retention_days
+    )
+    day = None
+    total = 0
+    while True:
+        match = {"battleTime": {"$lt": to_battle_time(cutoff)}}
+        if day is not None:
+            match["battleTime"]["$gte"] = to_battle_time(day + timedelta(days=1))
+        oldest = db["battles"].find_one(match, {"battleTime": 1}, sort=[("battleTime", 1)])
+        if oldest is None:
+            break
+        day = datetime.strptime(oldest["battleTime"][:8], "%Y%m%d")
+        total += archive_day(db, day, archive_dir)
+    logging.info(f"Archived {total} battles older than {cutoff.date()}.")
+
+    if compact and total:
+        try:
+            db.command("compact", "battles")
+        except OperationFailure as err:
+            # Clusters compartilhados do Atlas nao permitem o compact
+            logging.warning(f"Could not compact the battles collection ({err}).")
+    return total
+
+
+def restore_battles(db, start_time, end_time, archive_dir=ARCHIVE_DIR, batch_size=BATCH_SIZE):
+    # Devolve para a colecao as batalhas arquivadas de um intervalo de datas.
+    # Elas mantem o _id e o ingestSeq originais e sao marcadas como restored
+    # para nao serem contadas de novo nos rollups
+    day = datetime.strptime(start_time, "%Y-%m-%d")
+    end_day = datetime.strptime(end_time, "%Y-%m-%d")
+    restored = 0
+    while day < end_day:
+        path = archive_path(archive_dir, day)
+        if os.path.exists(path):
+            operations = []
+            with gzip.open(path, "rt", encoding="utf-8") as archive:
+                for line in archive:
+                    battle = json_util.loads(line)
+                    battle["restored"] = True
+                    operations.append(ReplaceOne({"_id": battle["_id"]}, battle, upsert=True))
+                    if len(operations) >= batch_size:
+                        db["battles"].bulk_write(operations, ordered=False)
+                        restored += len(operations)
+                        operations = []
+            if operations:
+                db["battles"].bulk_write(operations, ordered=False)
+                restored += len(operations)
+        day += timedelta(days=1)
+    logging.info(f"Restored {restored} battles from {start_time} to {end_time}.")
+    return restored
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Battle retention, archival and restore")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    archive_parser = subparsers.add_parser("archive", help="archive battles older than the horizon")
+    archive_parser.add_argument("--days", type=int, default=RETENTION_DAYS)
+    archive_parser.add_argument("--dir", default=ARCHIVE_DIR)
+    archive_parser.add_argument(
+        "--compact", action="store_true", help="run compact on battles after archiving"
+    )
+    restore_parser = subparsers.add_parser("restore", help="restore archived battles of a date range")
+    restore_parser.add_argument("start_time", help="YYYY-MM-DD")
+    restore_parser.add_argument("end_time", help="YYYY-MM-DD")
+    restore_parser.add_argument("--dir", default=ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))["clash_royale"]
+    if args.command == "archive":
+        archive_battles(db, args.days, args.dir, args.compact)
+    else:
+        restore_battles(db, args.start_time, args.end_time, args.dir)
@@ -0,0 +1,402 @@
+import argparse
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from itertools import combinations
+
+import pymongo
+from bson.binary import Binary
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from archetypes import deck_key
+from sketches import HyperLogLog
+
+# Tempo que uma batalha precisa ter sido gravada antes de ser lida pelo
+# modo polling. So cobre gravacoes que terminam dentro dessa janela depois de
+# reservar a sequencia: quem pode demorar mais (importacao de dumps) precisa
+# gravar em ordem de ingestSeq para nao ter sequencias puladas
+SETTLE_SECONDS = int(os.getenv("ROLLUP_SETTLE_SECONDS", "5"))
+FLUSH_BATTLES = int(os.getenv("ROLLUP_FLUSH_BATTLES", "5000"))
+FLUSH_SECONDS = float(os.getenv("ROLLUP_FLUSH_SECONDS", "2"))
+CHECKPOINT_ID = "battles"
+
+
+def next_sequence(db, name, count=1):
+    # Reserva count numeros de sequencia e devolve o primeiro deles
+    counter = db["counters"].find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+    return counter["seq"] - count + 1
+
+
+def ensure_rollup_indexes(db):
+    db["battles"].create_index("ingestSeq")
+    db["card_hourly"].create_index([("card", 1), ("hour", 1)], unique=True)
+    db["battle_hourly"].create_index("hour", unique=True)
+    db["deck_daily"].create_index([("deck", 1), ("day", 1)], unique=True)
+    db["deck_daily"].create_index("day")
+    db["combo_daily"].create_index([("combo", 1), ("day", 1)], unique=True)
+    db["combo_daily"].create_index("day")
+    db["deck_hll_daily"].create_index("day", unique=True)
+    # Ranking de jogadores: percorre o indice por winRate e filtra por games
+    db["player_stats"].create_index([("winRate", -1), ("games", 1)])
+
+
+def assign_missing_sequences(db, batch_size=1000):
+    # Batalhas gravadas antes do ingestSeq recebem uma sequencia para que o
+    # consumidor as inclua nos rollups
+    assigned = 0
+    while True:
+        battles = list(
+            db["battles"].find({"ingestSeq": {"$exists": False}}, {"_id": 1}).limit(batch_size)
+        )
+        if not battles:
+            break
+        first = next_sequence(db, "battles", len(battles))
+        ingested_at = datetime.utcnow()
+        db["battles"].bulk_write(
+            [
+                UpdateOne(
+                    {"_id": battle["_id"]},
+                    {"$set": {"ingestSeq": first + offset, "ingestedAt": ingested_at}},
+                )
+                for offset, battle in enumerate(battles)
+            ],
+            ordered=False,
+        )
+        assigned += len(battles)
+    logging.info(f"Assigned ingest sequence to {assigned} battles.")
+
+
+def battle_hour(battle_time):
+    return datetime.strptime(battle_time[:11], "%Y%m%dT%H")
+
+
+class RollupCounters:
+    # Contadores acumulados em memoria entre dois flushes
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.battles = 0
+        self.battle_hours = {}
+        self.cards = {}
+        self.decks = {}
+        self.combos = {}
+        self.deck_sketches = {}
+        self.players = {}
+
+    def add_players(self, battle):
+        # Agregados por jogador: total, por deck, por carta e contra oponentes
+        # que comecaram a partida com mais trofeus
+        for side, opponent, win in (
+            (battle["winner"], battle["loser"], 1),
+            (battle["loser"], battle["winner"], 0),
+        ):
+            if not side.get("tag"):
+                continue
+            counter = self.players.setdefault(side["tag"], {"name": side.get("name"), "inc": {}})
+            cards = side.get("cards", [])
+            prefixes = [""] + [f"cards.{card}." for card in cards]
+            if cards:
+                prefixes.append(f"decks.{deck_key(cards)}.")
+            trophies = side.get("startingTrophies")
+            opponent_trophies = opponent.get("startingTrophies")
+            if trophies is not None and opponent_trophies is not None:
+                if opponent_trophies > trophies:
+                    prefixes.append("vsHigher.")
+            for prefix in prefixes:
+                for field, value in (("games", 1), ("wins", win)):
+                    counter["inc"][prefix + field] = counter["inc"].get(prefix + field, 0) + value
+
+    def flush_players(self, db):
+        if not self.players:
+            return
+        db["player_stats"].bulk_write(
+            [
+                UpdateOne(
+                    {"_id": tag},
+                    {"$inc": counter["inc"], "$set": {"name": counter["name"]}},
+                    upsert=True,
+                )
+                for tag, counter in self.players.items()
+            ],
+            ordered=False,
+        )
+        # A taxa de vitoria e recalculada no servidor a partir dos totais ja
+        # incrementados, para o indice do ranking
+        db["player_stats"].bulk_write(
+            [
+                UpdateOne(
+                    {"_id": tag},
+                    [
+                        {
+                            "$set": {
+                                "winRate": {"$multiply": [{"$divide": ["$wins", "$games"]}, 100]}
+                            }
+                        }
+                    ],
+                )
+                for tag in self.players
+            ],
+            ordered=False,
+        )
+
+    def add_battle(self, battle):
+        hour = battle_hour(battle["battleTime"])
+        day = hour.replace(hour=0)
+        winner_cards = battle["winner"].get("cards", [])
+        loser_cards = battle["loser"].get("cards", [])
+
+        self.battles += 1
+        self.battle_hours[hour] = self.battle_hours.get(hour, 0) + 1
+        self.add_players(battle)
+
+        # Uso conta uma vez por batalha (uniao dos decks), como em
+        # cards_win_rate_usage_rate; vitoria quando a carta esta no vencedor
+        winner_set = set(winner_cards)
+        for card in winner_set | set(loser_cards):
+            counter = self.cards.setdefault((hour, card), [0, 0])
+            counter[0] += card in winner_set
+            counter[1] += 1
+
+        for cards, win in ((winner_cards, 1), (loser_cards, 0)):
+            if not cards:
+                continue
+            key = deck_key(cards)
+            counter = self.decks.setdefault((day, key), [0, 0, sorted(cards)])
+            counter[0] += win
+            counter[1] += 1
+            self.deck_sketches.setdefault(day, HyperLogLog()).add(key)
+            for combo in combinations(sorted(cards), 2):
+                counter = self.combos.setdefault((day, combo), [0, 0])
+                counter[0] += win
+                counter[1] += 1
+
+    def flush(self, db):
+        if not self.battles:
+            return 0
+        started = time.monotonic()
+        db["battle_hourly"].bulk_write(
+            [
+                UpdateOne({"hour": hour}, {"$inc": {"battles": battles}}, upsert=True)
+                for hour, battles in self.battle_hours.items()
+            ],
+            ordered=False,
+        )
+        db["card_hourly"].bulk_write(
+            [
+                UpdateOne(
+                    {"hour": hour, "card": card},
+                    {"$inc": {"wins": wins, "uses": uses}},
+                    upsert=True,
+                )
+                for (hour, card), (wins, uses) in self.cards.items()
+            ],
+            ordered=False,
+        )
+        db["deck_daily"].bulk_write(
+            [
+                UpdateOne(
+                    {"day": day, "deck": key},
+                    {"$inc": {"wins": wins, "games": games}, "$setOnInsert": {"cards": cards}},
+                    upsert=True,
+                )
+                for (day, key), (wins, games, cards) in self.decks.items()
+            ],
+            ordered=False,
+        )
+        db["combo_daily"].bulk_write(
+            [
+                UpdateOne(
+                    {"day": day, "combo": deck_key(combo)},
+                    {
+                        "$inc": {"wins": wins, "games": games},
+                        "$setOnInsert": {"cards": list(combo)},
+                    },
+                    upsert=True,
+                )
+                for (day, combo), (wins, games) in self.combos.items()
+            ],
+            ordered=False,
+        )
+        # Os HyperLogLog diarios de decks distintos sao combinados com os ja
+        # gravados (maximo de cada registrador); o consumidor e o unico escritor
+        for day, sketch in self.deck_sketches.items():
+            stored = db["deck_hll_daily"].find_one({"day": day})
+            if stored is not None:
+                sketch.merge(HyperLogLog.from_bytes(stored["registers"]))
+            db["deck_hll_daily"].update_one(
+                {"day": day}, {"$set": {"registers": Binary(sketch.to_bytes())}}, upsert=True
+            )
+        self.flush_players(db)
+        flushed = self.battles
+        logging.info(f"Flushed rollups of {flushed} battles in {time.monotonic() - started:.2f}s.")
+        self.reset()
+        return flushed
+
+
+def rebuild_player_stats(db, batch_size=FLUSH_BATTLES):
+    # Recalcula player_stats a partir das batalhas ja contadas pelo consumidor
+    # (ingestSeq ate o checkpoint); as batalhas arquivadas ficam de fora
+    checkpoint = db["rollup_checkpoints"].find_one({"_id": CHECKPOINT_ID}) or {}
+    db["player_stats"].delete_many({})
+    counters = RollupCounters()
+    rebuilt = 0
+    cursor = db["battles"].find(
+        {"ingestSeq": {"$lte": checkpoint.get("seq", 0)}, "restored": {"$ne": True}},
+        {"winner": 1, "loser": 1},
+        batch_size=10000,
+    )
+    for battle in cursor:
+        counters.add_players(battle)
+        rebuilt += 1
+        if rebuilt % batch_size == 0:
+            counters.flush_players(db)
+            counters.players = {}
+    counters.flush_players(db)
+    logging.info(f"Rebuilt player stats from {rebuilt} battles.")
+
+
+class RollupConsumer:
+    # Le as batalhas novas (change stream ou polling por ingestSeq), acumula os
+    # contadores e grava em lotes. O checkpoint e salvo logo depois de cada
+    # flush; uma queda entre os dois pode contar um lote duas vezes.
+
+    def __init__(self, db, flush_battles=FLUSH_BATTLES, flush_seconds=FLUSH_SECONDS):
+        self.db = db
+        self.flush_battles = flush_battles
+        self.flush_seconds = flush_seconds
+        self.counters = RollupCounters()
+        self.last_flush = time.monotonic()
+        checkpoint = db["rollup_checkpoints"].find_one({"_id": CHECKPOINT_ID}) or {}
+        self.seq = checkpoint.get("seq", 0)
+        self.resume_token = checkpoint.get("resumeToken")
+
+    def flush_due(self):
+        return self.counters.battles >= self.flush_battles or (
+            self.counters.battles and time.monotonic() - self.last_flush >= self.flush_seconds
+        )
+
+    def flush(self):
+        self.counters.flush(self.db)
+        self.db["rollup_checkpoints"].update_one(
+            {"_id": CHECKPOINT_ID},
+            {
+                "$set": {
+                    "seq": self.seq,
+                    "resumeToken": self.resume_token,
+                    "updatedAt": datetime.utcnow(),
+                }
+            },
+            upsert=True,
+        )
+        self.last_flush = time.monotonic()
+
+    def poll_once(self, batch_size=10000):
+        settled = datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)
+        cursor = (
+            self.db["battles"]
+            .find(
+                {"ingestSeq": {"$gt": self.seq}, "ingestedAt": {"$lte": settled}},
+                {"battleTime": 1, "winner": 1, "loser": 1, "ingestSeq": 1},
+            )
+            .sort("ingestSeq", 1)
+            .limit(batch_size)
+        )
+        processed = 0
+        for battle in cursor:
+            self.counters.add_battle(battle)
+            self.seq = battle["ingestSeq"]
+            processed += 1
+            if self.counters.battles >= self.flush_battles:
+                self.flush()
+        return processed
+
+    def run_polling(self, interval=1.0):
+        logging.info(f"Polling battles after ingest sequence {self.seq}...")
+        while True:
+            processed = self.poll_once()
+            if self.flush_due():
+                self.flush()
+            if not processed:
+                time.sleep(interval)
+
+    def run_change_stream(self):
+        # Abre o stream antes de alcancar o fim da colecao; as batalhas que
+        # ja foram lidas no catch-up sao descartadas pelo ingestSeq, e as
+        # restauradas do arquivo (retention.py) ja foram contadas
+        with self.db["battles"].watch(
+            [{"$match": {"operationType": "insert", "fullDocument.restored": {"$ne": True}}}],
+            resume_after=self.resume_token,
+        ) as stream:
+            caught_up_seq = 0
+            if self.resume_token is None:
+                # Espera as batalhas gravadas antes da abertura do stream
+                # ficarem visiveis para o polling
+                time.sleep(SETTLE_SECONDS)
+                while self.poll_once():
+                    pass
+                self.flush()
+                caught_up_seq = self.seq
+            logging.info("Tailing battle inserts through the change stream...")
+            while stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    battle = change["fullDocument"]
+                    if battle.get("ingestSeq", 0) > caught_up_seq:
+                        self.counters.add_battle(battle)
+                        self.seq = max(self.seq, battle.get("ingestSeq", 0))
+                    self.resume_token = stream.resume_token
+                elif not self.counters.battles:
+                    self.resume_token = stream.resume_token
+                    time.sleep(0.2)
+                if self.flush_due():
+                    self.flush()
+
+    def run(self, mode="auto", interval=1.0):
+        ensure_rollup_indexes(self.db)
+        if mode in ("auto", "stream"):
+            try:
+                return self.run_change_stream()
+            except OperationFailure as err:
+                if mode == "stream":
+                    raise
+                # mongod standalone nao suporta change streams
+                logging.warning(f"Change streams unavailable ({err}), falling back to polling.")
+        return self.run_polling(interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Keep card, deck and combo rollups live")
+    parser.add_argument("--mode", choices=["auto", "stream", "poll"], default="auto")
+    parser.add_argument("--interval", type=float, default=1.0, help="polling interval in seconds")
+    parser.add_argument(
+        "--rebuild-players",
+        action="store_true",
+        help="recompute player_stats from the battles already counted before tailing",
+    )
+    parser.add_argument(
+        "--backfill",
+        action="store_true",
+        help="assign an ingest sequence to battles stored before the consumer existed",
+    )
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))["clash_royale"]
+    if args.backfill:
+        assign_missing_sequences(db)
+    if args.rebuild_players:
+        ensure_rollup_indexes(db)
+        rebuild_player_stats(db)
+    RollupConsumer(db).run(args.mode, args.interval)
@@ -0,0 +1,106 @@
+import argparse
+import hashlib
+import logging
+import math
+import os
+
+import numpy as np
+import pymongo
+from dotenv import load_dotenv
+
+
+def hash64(value, seed=0):
+    digest = hashlib.blake2b(
+        str(value).encode("utf-8"), digest_size=8, salt=seed.to_bytes(8, "little")
+    ).digest()
+    return int.from_bytes(digest, "little")
+
+
+class HyperLogLog:
+    # Contagem aproximada de elementos distintos com 2^precision registradores
+    # de 1 byte; erro padrao relativo de 1.04 / sqrt(2^precision)
+
+    def __init__(self, precision=14, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            registers = np.zeros(self.size, dtype=np.uint8)
+        self.registers = registers
+
+    def add(self, value):
+        hashed = hash64(value)
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size**2 / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        # Correcao para cardinalidades pequenas (linear counting)
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)
+        return estimate
+
+    def relative_error(self):
+        return 1.04 / math.sqrt(self.size)
+
+    def to_bytes(self):
+        return self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, precision=14):
+        return cls(precision, np.frombuffer(data, dtype=np.uint8).copy())
+
+
+class CountMinSketch:
+    # Frequencia aproximada de chaves: a estimativa nunca e menor que o valor
+    # real e excede o valor real em no maximo epsilon * total com
+    # probabilidade 1 - delta, onde epsilon = e / width e delta = e^-depth
+
+    def __init__(self, width=2048, depth=5):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def columns(self, key):
+        return [hash64(key, seed) % self.width for seed in range(self.depth)]
+
+    def add(self, key, count=1):
+        self.total += count
+        columns = self.columns(key)
+        self.table[range(self.depth), columns] += count
+        return int(self.table[range(self.depth), columns].min())
+
+    def estimate(self, key):
+        return int(self.table[range(self.depth), self.columns(key)].min())
+
+    def error_bound(self):
+        return math.e / self.width * self.total
+
+
+def assign_sample_keys(db):
+    # Sorteia o sampleKey das batalhas gravadas antes do modo aproximado
+    result = db["battles"].update_many(
+        {"sampleKey": {"$exists": False}}, [{"$set": {"sampleKey": {"$rand": {}}}}]
+    )
+    db["battles"].create_index([("battleTime", 1), ("sampleKey", 1)])
+    logging.info(f"Assigned sample keys to {result.modified_count} battles.")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Sampling support for approximate queries")
+    parser.add_argument("command", choices=["backfill"], help="assign sample keys to stored battles")
+    args = parser.parse_args()
+
+    db = pymongo.MongoClient(os.getenv("MONGO_URI"))["clash_royale"]
+    assign_sample_keys(db)
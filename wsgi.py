@@ -0,0 +1,9 @@
+import logging
+
+from app import app
+
+# Ponto de entrada para servidores WSGI de producao, por exemplo:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# A criacao do MongoClient e o warm-up de cada worker ficam no hook
+# post_fork do gunicorn.conf.py.
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")